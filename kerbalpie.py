@@ -19,12 +19,14 @@ from PyQt5.QtWidgets import QAbstractItemView, QApplication, QHeaderView
 from PyQt5.QtWidgets import QTabWidget, QVBoxLayout, QWidget
 
 from lib.logger import Logger
+from lib.widgets.QHeatmap import QHeatmap
 from lib.widgets.QPlot2D import QPlot2D, QPlot2DTime
 from lib.widgets.QPidController import QPidControllerPanel
 from lib.kp_flight_controller import KPFlightController
 from lib.kp_flight_data import KPFlightDataModel
+from lib.kp_input_shaping import KPAxisShaping, KPInputShaper
 from lib.kp_mission_control import KPMissionProgramsModel, KPMissionProgramsDatabase
-from lib.kp_serial_interface import KPSerialInterface
+from lib.kp_serial_interface import KPSerialDevice, KPSerialInterface
 from lib.kp_tools import *
 
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
@@ -39,6 +41,7 @@ class KerbalPie(QWidget):
     _CFG_GLOBALS_SECTION = 'GLOBALS'
     _CFG_KRPC_SECTION    = 'KRPC'
     _CFG_SERIAL_SECTION  = 'SERIAL'
+    _CFG_INPUT_SECTION   = 'INPUT'
     
     # S I G N A L S 
     #===========================================================================
@@ -66,7 +69,22 @@ class KerbalPie(QWidget):
         self._logger_thread = Logger(
             log_dir=self.config['logger_directory'], 
             log_name=self.config['logger_filename'], 
-            debug_on=True)
+            debug_on=True,
+            batch_size=self.config['logger_batch_size'],
+            flush_size=self.config['logger_flush_size'],
+            flush_interval=self.config['logger_flush_interval'],
+            fsync=self.config['logger_fsync'],
+            queue_size=self.config['logger_queue_size'],
+            overflow=self.config['logger_overflow'],
+            drop_report_interval=self.config['logger_drop_report_interval'],
+            log_format=self.config['logger_format'],
+            rotate_size=self.config['logger_rotate_size'],
+            rotate_on_start=self.config['logger_rotate_on_start'],
+            compress=self.config['logger_compress'],
+            keep_segments=self.config['logger_keep_segments'],
+            keep_days=self.config['logger_keep_days'],
+            level=self.config['logger_level'],
+            aggregate_window=self.config['logger_aggregate_window'])
         self._logger_thread.start()
         
 
@@ -75,9 +93,14 @@ class KerbalPie(QWidget):
         
         # interface thread
         self._serial_thread = QtCore.QThread()
+        serial_devices = [KPSerialDevice('controller', self.config['serial_port'], self.config['serial_baudrate'])]
+        for device_config in self.config['serial_devices']:
+            serial_devices.append(KPSerialDevice(**device_config))
         self._serial_iface = KPSerialInterface(
-            serial_port=self.config['serial_port'], 
-            serial_baudrate=self.config['serial_baudrate'])
+            devices=serial_devices,
+            downlink_rate=self.config['serial_downlink_rate'],
+            capture_file=self.config['serial_capture_file'],
+            replay_file=self.config['serial_replay_file'])
         self._serial_iface.moveToThread(self._serial_thread)
         
 
@@ -90,7 +113,11 @@ class KerbalPie(QWidget):
             krpc_address=self.config['krpc_address'], 
             krpc_rpc_port=self.config['krpc_rpc_port'], 
             krpc_stream_port=self.config['krpc_stream_port'], 
-            krpc_name=self.config['krpc_client_name'])
+            krpc_name=self.config['krpc_client_name'],
+            clock=create_clock(self.config['control_clock']),
+            vspeed_gain_table=self.config['vspeed_gain_table'],
+            terrain_cache_dir=self.config['terrain_cache_directory'],
+            input_shaping={axis : KPAxisShaping(**shaping) for (axis, shaping) in self.config['input_shaping'].items()})
         self._flight_ctrl.moveToThread(self._flight_thread)
         
 
@@ -138,7 +165,8 @@ class KerbalPie(QWidget):
         self.krpc_rpcPortEdit.textChanged.connect(self.krpc_client_rpc_port_changed)
         self.krpc_streamPortEdit.textChanged.connect(self.krpc_client_stream_port_changed)
 
-        self._serial_iface.rc_command.connect(self._flight_ctrl.rc_command_received)
+        self._flight_ctrl.set_rc_source(self._serial_iface.rc_state)
+        self._flight_ctrl.set_downlink(self._serial_iface.downlink)
         
         # start threads
         self._flight_thread.start()
@@ -215,29 +243,15 @@ class KerbalPie(QWidget):
         # debug
         #-----------------------------------------------------------------------
         
-        self.radarPlotter = QPlot2D(
-            xMin=-1.0,
-            xMax=1.0,
-            yMin=-1.0,
-            yMax=1.0,
-            xOriginValue=0.0,
-            yOriginValue=0.0,
-            xTickInterval=0.1,
-            yTickInterval=0.1)
+        self.radarHeatmap = QHeatmap(
+            colorBins=60,
+            hueMin=0.0,
+            hueMax=0.2,
+            highlightBand=1.0)
             
         radarLayout = QVBoxLayout()
-        radarLayout.addWidget(self.radarPlotter)
+        radarLayout.addWidget(self.radarHeatmap)
         self.radarTab.setLayout(radarLayout)
-        
-        self._radarPlotColorBins = 60
-        radarPlotColor = QColor()
-        for i in range(self._radarPlotColorBins):
-            hue = map_value_to_scale(float(i), 0.0, float(self._radarPlotColorBins), 0.0, 0.2) 
-            radarPlotColor.setHsvF(hue, 1.0, 1.0)
-            self.radarPlotter.setPlotPen(i, QPen(radarPlotColor, 15.0, Qt.SolidLine, Qt.RoundCap))
-        self.radarPlotter.setPlotPen(self._radarPlotColorBins, QPen(Qt.blue, 15.0, Qt.SolidLine, Qt.RoundCap))
-                
-        #self.radarPlotter.update()
            
     
     # S L O T S 
@@ -335,39 +349,7 @@ class KerbalPie(QWidget):
             self.controllerPlotter.updatePlot(0, telemetry_dict['vessel_mean_altitude'])
             
         # radar
-        '''
-        self.radarPlotter.clearPlots()
-        
-        #surface_height_at_vessel = telemetry_dict['vessel_surface_height']
-        radar_altitude_map = telemetry_dict['surface_height_map']
-        
-        #print(radar_altitude_map)
-        
-        radar_altitude_map_min = min([min(a) for a in radar_altitude_map])
-        radar_altitude_map_max = max([max(a) for a in radar_altitude_map])
-        
-        if radar_altitude_map_min == 0.0 and radar_altitude_map_max == 0.0:
-            radar_altitude_map_min = -1.0
-            radar_altitude_map_max = 1.0
-        
-        s = len(telemetry_dict['surface_height_map'][0])
-        for y in range(s):
-            for x in range(s):
-                x_val = map_value_to_scale(float(x) + 0.5, 0.0, s, -1.0, 1.0)
-                y_val = map_value_to_scale(float(y) + 0.5, 0.0, s, -1.0, 1.0)
-                alt = radar_altitude_map[y][x]
-                bin = map_value_to_scale(alt, radar_altitude_map_min, radar_altitude_map_max, 0.1, self._radarPlotColorBins - 0.1)
-                #bin = map_value_to_scale(x_val, -1.0, 1.0, 0.1, 19.9)
-                
-                bin = int(bin)
-                
-                if alt > (telemetry_dict['vessel_surface_height'] - 1.0) and alt < (telemetry_dict['vessel_surface_height'] + 1.0):
-                    self.radarPlotter.updatePlot(self._radarPlotColorBins, (x_val, y_val))
-                else:
-                    self.radarPlotter.updatePlot(bin, (x_val, y_val))
-                
-        self.radarPlotter.update()
-        '''
+        self.radarHeatmap.setFrame(telemetry_dict['radar_frame'])
         
         
     @pyqtSlot('QString')
@@ -414,14 +396,62 @@ class KerbalPie(QWidget):
         config = {
             'logger_directory'  : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_directory'),
             'logger_filename'   : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_filename'),
+            'logger_level'      : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_level'),
+            'logger_aggregate_window' : cfg.getfloat(KerbalPie._CFG_GLOBALS_SECTION, 'logger_aggregate_window'),
+            'logger_format'     : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_format'),
+            'logger_rotate_size' : cfg.getint(KerbalPie._CFG_GLOBALS_SECTION, 'logger_rotate_size'),
+            'logger_rotate_on_start' : cfg.getboolean(KerbalPie._CFG_GLOBALS_SECTION, 'logger_rotate_on_start'),
+            'logger_compress'   : cfg.getboolean(KerbalPie._CFG_GLOBALS_SECTION, 'logger_compress'),
+            'logger_keep_segments' : cfg.getint(KerbalPie._CFG_GLOBALS_SECTION, 'logger_keep_segments'),
+            'logger_keep_days'  : cfg.getfloat(KerbalPie._CFG_GLOBALS_SECTION, 'logger_keep_days'),
+            'logger_batch_size' : cfg.getint(KerbalPie._CFG_GLOBALS_SECTION, 'logger_batch_size'),
+            'logger_flush_size' : cfg.getint(KerbalPie._CFG_GLOBALS_SECTION, 'logger_flush_size'),
+            'logger_flush_interval' : cfg.getfloat(KerbalPie._CFG_GLOBALS_SECTION, 'logger_flush_interval'),
+            'logger_fsync'      : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_fsync'),
+            'logger_queue_size' : cfg.getint(KerbalPie._CFG_GLOBALS_SECTION, 'logger_queue_size'),
+            'logger_overflow'   : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'logger_overflow'),
+            'logger_drop_report_interval' : cfg.getfloat(KerbalPie._CFG_GLOBALS_SECTION, 'logger_drop_report_interval'),
+            'control_clock'     : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'control_clock'),
+            'vspeed_gain_table' : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'vspeed_gain_table'),
+            'terrain_cache_directory' : cfg.get(KerbalPie._CFG_GLOBALS_SECTION, 'terrain_cache_directory'),
             'krpc_address'      : cfg.get(KerbalPie._CFG_KRPC_SECTION, 'krpc_address'),
             'krpc_client_name'  : cfg.get(KerbalPie._CFG_KRPC_SECTION, 'krpc_client_name'),
             'krpc_rpc_port'     : cfg.getint(KerbalPie._CFG_KRPC_SECTION, 'krpc_rpc_port'),
             'krpc_stream_port'  : cfg.getint(KerbalPie._CFG_KRPC_SECTION, 'krpc_stream_port'),
             'serial_port'       : cfg.get(KerbalPie._CFG_SERIAL_SECTION, 'serial_port'),
             'serial_baudrate'   : cfg.getint(KerbalPie._CFG_SERIAL_SECTION, 'serial_baudrate'),
+            'serial_downlink_rate' : cfg.getfloat(KerbalPie._CFG_SERIAL_SECTION, 'serial_downlink_rate'),
+            'serial_capture_file' : cfg.get(KerbalPie._CFG_SERIAL_SECTION, 'serial_capture_file'),
+            'serial_replay_file'  : cfg.get(KerbalPie._CFG_SERIAL_SECTION, 'serial_replay_file'),
+            'serial_devices'    : [],
+            'input_shaping'     : {},
         }
         
+        # joystick axis shaping
+        for axis in KPInputShaper.axes:
+            config['input_shaping'][axis] = {
+                'invert'        : cfg.getboolean(KerbalPie._CFG_INPUT_SECTION, axis + '_invert'),
+                'dead_zone'     : cfg.getfloat(KerbalPie._CFG_INPUT_SECTION, axis + '_dead_zone'),
+                'expo'          : cfg.getfloat(KerbalPie._CFG_INPUT_SECTION, axis + '_expo'),
+                'trim'          : cfg.getfloat(KerbalPie._CFG_INPUT_SECTION, axis + '_trim'),
+                'calibration'   : [float(value) for value in cfg.get(KerbalPie._CFG_INPUT_SECTION, axis + '_calibration').split(',')],
+            }
+        
+        # additional serial input devices, each in a [SERIAL_<name>] section
+        for name in cfg.get(KerbalPie._CFG_SERIAL_SECTION, 'serial_devices').split(','):
+            name = name.strip()
+            if len(name) == 0:
+                continue
+            section = KerbalPie._CFG_SERIAL_SECTION + '_' + name.upper()
+            config['serial_devices'].append({
+                'name'      : name,
+                'port'      : cfg.get(section, 'port'),
+                'baudrate'  : cfg.getint(section, 'baudrate'),
+                'priority'  : cfg.getint(section, 'priority'),
+                'controls'  : [control.strip() for control in cfg.get(section, 'controls').split(',')],
+                'downlink'  : cfg.getboolean(section, 'downlink'),
+            })
+        
         return config
         
         
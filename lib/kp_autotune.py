@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import argparse, json, os, time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.kp_tools import clamp
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  F U N C T I O N S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+# vertical speed setpoint steps flown by every candidate: (duration, setpoint)
+_TUNE_PROFILE = [
+    (6.0,  2.0),
+    (6.0, -2.0),
+    (6.0,  0.0),
+]
+
+# candidate gains, as multiples of ku = 1 / (twr * gravity), the gain at which
+# a 1 m/s speed error commands 1 m/s^2 of thrust acceleration
+_TUNE_KP_RATIOS = np.geomspace(0.3, 100.0, 22)
+_TUNE_KI_RATIOS = np.geomspace(0.05, 300.0, 22)
+_TUNE_KD_RATIOS = np.concatenate(([0.0], np.geomspace(0.01, 5.0, 10)))
+
+
+def simulate_vspeed_candidates(twr, gravity, kp, ki, kd, dt=0.050, substeps=5, throttle_lag=0.1, measurement_delay=2):
+    # Simulates a 1-D vertical dynamics model flown by a batch of vertical
+    # speed PID controllers at once. kp, ki and kd are arrays of candidate
+    # gains; every array operation advances all candidates together. The
+    # controller mirrors PidController.update: derivative on measurement,
+    # integral and output clamped to the throttle range [0, 1]. The measured
+    # speed lags the true speed by measurement_delay ticks (telemetry latency).
+    #
+    # Returns the cost of each candidate (lower is better).
+    n = len(kp)
+    v = np.zeros(n)
+    v_history = [np.zeros(n)] * (measurement_delay + 1)
+    throttle = np.zeros(n)
+    u = np.zeros(n)
+    integral = np.zeros(n)
+    prev_v = np.zeros(n)
+
+    cost = np.zeros(n)
+    sub_dt = dt / substeps
+    lag = min(1.0, sub_dt / throttle_lag) if throttle_lag > 0.0 else 1.0
+
+    for (duration, set_point) in _TUNE_PROFILE:
+        for tick in range(int(round(duration / dt))):
+
+            # controller update on the delayed measurement
+            v_measured = v_history[0]
+            error = set_point - v_measured
+            u_prev = u
+            u = np.clip(kp * error + integral - kd * (v_measured - prev_v) / dt, 0.0, 1.0)
+            integral = np.clip(integral + ki * error * dt, 0.0, 1.0)
+            prev_v = v_measured
+
+            # vessel dynamics, with a first order throttle response
+            for s in range(substeps):
+                throttle += (u - throttle) * lag
+                v = v + gravity * (twr * throttle - 1.0) * sub_dt
+            v_history = v_history[1:] + [v]
+
+            # time-weighted absolute error, plus a penalty on throttle chatter
+            t = tick * dt
+            cost += (1.0 + t) * np.abs(set_point - v) * dt + 0.2 * np.abs(u - u_prev)
+
+    # diverged candidates are never selected
+    cost[~np.isfinite(cost)] = np.inf
+    return cost
+
+
+def tune_vspeed_gains(twr, gravity, dt=0.050):
+    # sweeps every gain candidate for a single (twr, gravity) point
+    ku = 1.0 / (twr * gravity)
+    kp_grid, ki_grid, kd_grid = np.meshgrid(_TUNE_KP_RATIOS, _TUNE_KI_RATIOS, _TUNE_KD_RATIOS, indexing='ij')
+    kp = kp_grid.ravel() * ku
+    ki = ki_grid.ravel() * ku
+    kd = kd_grid.ravel() * ku
+
+    # score each candidate on its worst case over a +/-20% thrust mismatch,
+    # so the table does not pick gains that only work for the nominal model.
+    # Mismatches that leave the vessel unable to hover fail every candidate
+    # alike, so they are not scored.
+    cost = np.zeros(len(kp))
+    for twr_error in (0.8, 1.0, 1.2):
+        if twr * twr_error <= 1.0:
+            continue
+        cost = np.maximum(cost, simulate_vspeed_candidates(twr * twr_error, gravity, kp, ki, kd, dt=dt))
+
+    # where the cost hardly depends on the gains (the integral and throttle
+    # saturate), prefer the gentlest of the near-best candidates
+    near_best = np.flatnonzero(cost <= np.min(cost) * 1.01)
+    best = int(near_best[np.argmin((kp + ki + kd)[near_best])])
+
+    return [float(kp[best]), float(ki[best]), float(kd[best])]
+
+
+def _tune_grid_point(args):
+    return tune_vspeed_gains(*args)
+
+
+def build_vspeed_gain_table(twr_range, gravity_range, dt=0.050, workers=None):
+    # twr_range and gravity_range are (min, max, count) tuples
+    twr_values = np.linspace(*twr_range)
+    gravity_values = np.linspace(*gravity_range)
+
+    grid_points = [(float(twr), float(gravity), dt) for twr in twr_values for gravity in gravity_values]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_tune_grid_point, grid_points, chunksize=4))
+
+    n_gravity = len(gravity_values)
+    gains = [results[i * n_gravity:(i + 1) * n_gravity] for i in range(len(twr_values))]
+
+    return KPGainTable(twr_range, gravity_range, gains)
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Gain lookup table
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# PID gains tabulated on a uniform (thrust-to-weight ratio, gravity) grid.
+# Lookups compute the grid cell directly and interpolate bilinearly, so the
+# cost per tick is constant. Values outside the grid are clamped to its edges.
+class KPGainTable():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, twr_range, gravity_range, gains):
+        assert int(twr_range[2]) > 1 and int(gravity_range[2]) > 1
+        
+        self._twr_min, self._twr_max, self._twr_count = float(twr_range[0]), float(twr_range[1]), int(twr_range[2])
+        self._g_min, self._g_max, self._g_count = float(gravity_range[0]), float(gravity_range[1]), int(gravity_range[2])
+        self._twr_step = (self._twr_max - self._twr_min) / max(1, self._twr_count - 1)
+        self._g_step = (self._g_max - self._g_min) / max(1, self._g_count - 1)
+        self._gains = [[tuple(g) for g in row] for row in gains]
+
+
+    # M E T H O D S
+    #===========================================================================
+    def lookup(self, twr, gravity):
+        (i, fi) = self._grid_position(twr, self._twr_min, self._twr_step, self._twr_count)
+        (j, fj) = self._grid_position(gravity, self._g_min, self._g_step, self._g_count)
+
+        g00 = self._gains[i][j]
+        g01 = self._gains[i][j + 1]
+        g10 = self._gains[i + 1][j]
+        g11 = self._gains[i + 1][j + 1]
+
+        return tuple(
+            (g00[k] * (1.0 - fj) + g01[k] * fj) * (1.0 - fi) + (g10[k] * (1.0 - fj) + g11[k] * fj) * fi
+            for k in range(3))
+
+
+    def save(self, filename):
+        table = {
+            'twr'       : [self._twr_min, self._twr_max, self._twr_count],
+            'gravity'   : [self._g_min, self._g_max, self._g_count],
+            'gains'     : self._gains,
+        }
+        with open(filename, 'w') as table_file:
+            json.dump(table, table_file, indent=1)
+
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as table_file:
+            table = json.load(table_file)
+        return KPGainTable(table['twr'], table['gravity'], table['gains'])
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _grid_position(self, value, value_min, step, count):
+        # index of the lower grid point and the fraction towards the next one
+        position = clamp(0.0, (value - value_min) / step, float(count - 1))
+        index = min(int(position), count - 2)
+        return (index, position - index)
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#  E N T R Y   P O I N T   =#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+if __name__ == '__main__':
+
+    # parse command-line arguments
+    #===========================================================================
+    arg_parser = argparse.ArgumentParser(description="Offline vertical speed PID autotuner")
+    arg_parser.add_argument("-o", "--output",
+        help="Gain table file to write",
+        default=os.path.join('data', 'vspeed_gains.json'))
+    arg_parser.add_argument("--twr",
+        help="Thrust-to-weight ratio grid: min max count",
+        nargs=3, type=float, default=[1.1, 5.0, 14])
+    arg_parser.add_argument("--gravity",
+        help="Gravity grid (m/s^2): min max count",
+        nargs=3, type=float, default=[0.5, 20.0, 10])
+    arg_parser.add_argument("-j", "--jobs",
+        help="Number of worker processes (default: one per CPU)",
+        type=int, default=None)
+    args = arg_parser.parse_args()
+
+    twr_range = (args.twr[0], args.twr[1], int(args.twr[2]))
+    gravity_range = (args.gravity[0], args.gravity[1], int(args.gravity[2]))
+
+    start_time = time.time()
+    gain_table = build_vspeed_gain_table(twr_range, gravity_range,
+        dt=0.050, workers=args.jobs)
+    gain_table.save(args.output)
+
+    print('Wrote {:d} x {:d} gain table to "{:s}" in {:.1f} s'.format(
+        twr_range[2], gravity_range[2], args.output, time.time() - start_time))
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import argparse, gzip, json, os, struct, sys, time
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  F U N C T I O N S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+# Binary log format. The log file is a sequence of records:
+#
+#   session   'R'                                     string table reset
+#   string    'S' <id: uint16> <size: uint16> <utf-8>   interned string
+#   entry     'E' <time: float64> <subsys id: uint16> <type id: uint16>
+#                 <message size: uint32> <data size: uint32>
+#                 <message: utf-8> <data: JSON object, or empty>
+#
+# Subsystem and type strings are interned: each is written once per session,
+# and entries refer to it by id. Any other fields of a log entry are stored
+# as a JSON object in the entry's data.
+#
+# Each batch of entries written by the logger is a block, and the sidecar
+# index file (log filename + '.idx') has one record per block:
+#
+#   block     'B' <first time: float64> <last time: float64>
+#                 <offset: uint64> <size: uint32> <subsystem mask: uint64>
+#
+# plus copies of the session and string records, so that a reader can load
+# the index alone and seek straight to the blocks of a time range and set of
+# subsystems. Bit i of the subsystem mask is set if the block has entries of
+# subsystem id i; ids from 63 up share bit 63.
+binary_log_magic = b'KPLOG1\n'
+binary_log_string = struct.Struct('<cHH')
+binary_log_entry = struct.Struct('<cdHHII')
+binary_log_block = struct.Struct('<cddQIQ')
+
+record_session = b'R'
+record_string = b'S'
+record_entry = b'E'
+record_block = b'B'
+
+entry_fields = ('time', 'subsys', 'type', 'message')
+
+
+def index_filename(log_filename):
+    # the index of a compressed log segment is compressed too
+    if log_filename.endswith('.gz'):
+        return log_filename[:-len('.gz')] + '.idx.gz'
+    return log_filename + '.idx'
+
+
+def open_log_file(filename):
+    # log files and rotated (gzip-compressed) segments
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def subsystem_bit(string_id):
+    return 1 << min(string_id, 63)
+
+
+def parse_records(data, strings, offset=0, end=None):
+    # log entry dictionaries from the records in data[offset:end]; string
+    # and session records update 'strings', the id -> string table
+    if end is None:
+        end = len(data)
+
+    while offset < end:
+        record_type = data[offset:offset + 1]
+
+        if record_type == record_entry:
+            (_, entry_time, subsys_id, type_id, message_size, data_size) = binary_log_entry.unpack_from(data, offset)
+            offset += binary_log_entry.size
+            log_entry = {
+                'time'      : entry_time,
+                'subsys'    : strings[subsys_id],
+                'type'      : strings[type_id],
+                'message'   : data[offset:offset + message_size].decode('utf-8'),
+            }
+            offset += message_size
+            if data_size > 0:
+                log_entry.update(json.loads(data[offset:offset + data_size].decode('utf-8')))
+                offset += data_size
+            yield log_entry
+
+        elif record_type == record_string:
+            (_, string_id, size) = binary_log_string.unpack_from(data, offset)
+            offset += binary_log_string.size
+            strings[string_id] = data[offset:offset + size].decode('utf-8')
+            offset += size
+
+        elif record_type == record_session:
+            strings.clear()
+            offset += 1
+
+        else:
+            raise ValueError('Corrupt binary log record at offset {:d}'.format(offset))
+
+
+def read_binary_log(filename):
+    # every entry of the log, in order
+    with open_log_file(filename) as f:
+        data = f.read()
+    if not data.startswith(binary_log_magic):
+        raise ValueError('Not a binary log file: {}'.format(filename))
+
+    for log_entry in parse_records(data, {}, len(binary_log_magic)):
+        yield log_entry
+
+
+def read_binary_log_range(filename, start_time=None, end_time=None, subsystems=None):
+    # entries between start_time and end_time (seconds since the epoch), of
+    # the given subsystems; only the blocks the index selects are read
+    with open_log_file(index_filename(filename)) as f:
+        index = f.read()
+
+    with open_log_file(filename) as log_file:
+        strings = {}
+        offset = len(binary_log_magic)
+
+        while offset < len(index):
+            record_type = index[offset:offset + 1]
+
+            if record_type != record_block:
+                # string table records
+                end = offset + 1
+                if record_type == record_string:
+                    end = offset + binary_log_string.size + binary_log_string.unpack_from(index, offset)[2]
+                for log_entry in parse_records(index, strings, offset, end):
+                    pass
+                offset = end
+                continue
+
+            (_, first_time, last_time, block_offset, block_size, subsys_mask) = binary_log_block.unpack_from(index, offset)
+            offset += binary_log_block.size
+
+            if start_time is not None and last_time < start_time:
+                continue
+            if end_time is not None and first_time > end_time:
+                continue
+            if subsystems is not None:
+                mask = 0
+                for (string_id, string) in strings.items():
+                    if string in subsystems:
+                        mask |= subsystem_bit(string_id)
+                if (subsys_mask & mask) == 0:
+                    continue
+
+            log_file.seek(block_offset)
+            block = log_file.read(block_size)
+            for log_entry in parse_records(block, strings):
+                if start_time is not None and log_entry['time'] < start_time:
+                    continue
+                if end_time is not None and log_entry['time'] > end_time:
+                    continue
+                if subsystems is not None and log_entry['subsys'] not in subsystems:
+                    continue
+                yield log_entry
+
+
+def parse_time(time_str):
+    # seconds since the epoch, or local 'YYYY-MM-DD HH:MM:SS'
+    try:
+        return float(time_str)
+    except ValueError:
+        return time.mktime(time.strptime(time_str, '%Y-%m-%d %H:%M:%S'))
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Binary log encoder
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Encodes batches of log entries into a block of log records and its index
+# record. The caller writes both, and passes the log file offset the block
+# is written at.
+class KPBinaryLogEncoder():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self):
+        self._string_ids = {}
+
+
+    # M E T H O D S
+    #===========================================================================
+    def start_session(self, new_log_file, new_index_file):
+        # records that start a session, for the log and the index file
+        self._string_ids = {}
+        return (
+            (binary_log_magic if new_log_file else b'') + record_session,
+            (binary_log_magic if new_index_file else b'') + record_session)
+
+
+    def encode(self, log_entries, offset):
+        # returns the block's log and index data
+        records = []
+        index_strings = []
+        subsys_mask = 0
+
+        for log_entry in log_entries:
+            subsys_id = self._intern(log_entry['subsys'], records, index_strings)
+            type_id = self._intern(log_entry['type'], records, index_strings)
+            subsys_mask |= subsystem_bit(subsys_id)
+
+            message = log_entry['message'].encode('utf-8')
+            if len(log_entry) > len(entry_fields):
+                data = json.dumps({key : value for (key, value) in log_entry.items() if key not in entry_fields}).encode('utf-8')
+            else:
+                data = b''
+
+            records.append(binary_log_entry.pack(record_entry, log_entry['time'], subsys_id, type_id, len(message), len(data)))
+            records.append(message)
+            records.append(data)
+
+        block = b''.join(records)
+        index_strings.append(binary_log_block.pack(record_block,
+            log_entries[0]['time'], log_entries[-1]['time'], offset, len(block), subsys_mask))
+
+        return (block, b''.join(index_strings))
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _intern(self, string, records, index_strings):
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self._string_ids)
+            self._string_ids[string] = string_id
+            encoded = string.encode('utf-8')
+            record = binary_log_string.pack(record_string, string_id, len(encoded)) + encoded
+            records.append(record)
+            index_strings.append(record)
+        return string_id
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#  E N T R Y   P O I N T   =#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+if __name__ == '__main__':
+
+    # parse command-line arguments
+    #===========================================================================
+    arg_parser = argparse.ArgumentParser(description="Convert a binary log to JSON lines")
+    arg_parser.add_argument("log_file",
+        help="Binary log file")
+    arg_parser.add_argument("-s", "--start",
+        help="First time to convert: seconds since the epoch, or 'YYYY-MM-DD HH:MM:SS'")
+    arg_parser.add_argument("-e", "--end",
+        help="Last time to convert: seconds since the epoch, or 'YYYY-MM-DD HH:MM:SS'")
+    arg_parser.add_argument("--subsys",
+        help="Subsystems to convert (comma-separated)")
+    arg_parser.add_argument("-o", "--output",
+        help="Output file (default: standard output)")
+    args = arg_parser.parse_args()
+
+    start_time = parse_time(args.start) if args.start else None
+    end_time = parse_time(args.end) if args.end else None
+    subsystems = set(args.subsys.split(',')) if args.subsys else None
+
+    # the index is only needed to select part of the log
+    if start_time is None and end_time is None and subsystems is None:
+        log_entries = read_binary_log(args.log_file)
+    elif os.path.isfile(index_filename(args.log_file)):
+        log_entries = read_binary_log_range(args.log_file, start_time, end_time, subsystems)
+    else:
+        sys.stderr.write('Index not found, scanning the whole log\n')
+        log_entries = (log_entry for log_entry in read_binary_log(args.log_file)
+            if (start_time is None or log_entry['time'] >= start_time)
+            and (end_time is None or log_entry['time'] <= end_time)
+            and (subsystems is None or log_entry['subsys'] in subsystems))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for log_entry in log_entries:
+        log_entry['localtime'] = time.asctime(time.localtime(log_entry['time']))
+        output.write(json.dumps(log_entry) + '\n')
+    if output is not sys.stdout:
+        output.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import math
+
+from lib.kp_tools import clamp
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Descent profile planner
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Plans a "suicide burn" style descent: the fastest vertical speed at each
+# altitude from which the vessel can still brake to the touchdown speed, using
+# only a fraction of its maximum thrust so the speed controller keeps some
+# authority in reserve:
+#
+#   a_brake = g * (twr * throttle_margin - 1)
+#   v(h)    = -sqrt(v_touchdown^2 + 2 * a_brake * (h - safety_altitude))
+#
+# The profile is tabulated on a uniform altitude grid, and only rebuilt when
+# the vessel mass, maximum thrust or gravity change materially. Lookups from
+# the STS are a constant-time linear interpolation.
+class KPDescentPlanner():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self,
+            touchdown_speed=1.0,
+            max_descent_speed=50.0,
+            throttle_margin=0.7,
+            safety_altitude=2.0,
+            table_size=256,
+            rebuild_tolerance=0.02):
+
+        # settings
+        self.touchdown_speed = touchdown_speed
+        self.max_descent_speed = max_descent_speed
+        self.throttle_margin = throttle_margin
+        self.safety_altitude = safety_altitude
+        self.table_size = max(2, table_size)
+        self.rebuild_tolerance = rebuild_tolerance
+
+        # vessel parameters the current table was built for
+        self._mass = None
+        self._max_thrust = None
+        self._gravity = None
+
+        # profile table
+        self._profile = [-touchdown_speed, -touchdown_speed]
+        self._altitude_step = 1.0
+        self._altitude_max = 1.0
+        self.rebuild_count = 0
+
+
+    # M E T H O D S
+    #===========================================================================
+    def update(self, mass, max_thrust, gravity):
+        # rebuild the profile table if the vessel parameters changed materially
+        if self._has_changed(self._mass, mass) or \
+                self._has_changed(self._max_thrust, max_thrust) or \
+                self._has_changed(self._gravity, gravity):
+            self._mass = mass
+            self._max_thrust = max_thrust
+            self._gravity = gravity
+            self._build_profile()
+            return True
+
+        return False
+
+
+    def vertical_speed(self, surface_altitude):
+        # vertical speed setpoint (negative = descending) for the given altitude
+        if surface_altitude >= self._altitude_max:
+            return self._profile[-1]
+
+        # rounding can put altitudes just below the top on the last entry
+        position = max(0.0, surface_altitude) / self._altitude_step
+        index = min(int(position), len(self._profile) - 2)
+        fraction = position - index
+
+        return self._profile[index] + (self._profile[index + 1] - self._profile[index]) * fraction
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _build_profile(self):
+        weight = self._mass * self._gravity
+        twr = (self._max_thrust / weight) if weight > 0.0 else 0.0
+        a_brake = self._gravity * (twr * self.throttle_margin - 1.0)
+
+        v_touchdown = self.touchdown_speed
+        v_max = max(self.max_descent_speed, v_touchdown)
+
+        if a_brake <= 1.0e-3:
+            # not enough thrust to brake, only descend at touchdown speed
+            self._profile = [-v_touchdown, -v_touchdown]
+            self._altitude_step = 1.0
+            self._altitude_max = 1.0
+
+        else:
+            # table spans up to the altitude where the speed limit is reached
+            self._altitude_max = self.safety_altitude + (v_max ** 2 - v_touchdown ** 2) / (2.0 * a_brake)
+            self._altitude_step = self._altitude_max / (self.table_size - 1)
+
+            self._profile = []
+            for i in range(self.table_size):
+                braking_altitude = max(0.0, i * self._altitude_step - self.safety_altitude)
+                v = math.sqrt(v_touchdown ** 2 + 2.0 * a_brake * braking_altitude)
+                self._profile.append(-clamp(v_touchdown, v, v_max))
+
+        self.rebuild_count += 1
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _has_changed(self, previous_value, value):
+        if previous_value is None:
+            return True
+        return abs(value - previous_value) > self.rebuild_tolerance * max(abs(previous_value), 1.0e-9)
@@ -1,4 +1,4 @@
-import collections, krpc, math, time
+import collections, krpc, math, os, time
 
 from time import sleep
 
@@ -7,6 +7,13 @@ from PyQt5.QtCore import QCoreApplication, Qt, QTimer, QVariant, pyqtSignal
 from PyQt5.QtCore import pyqtSlot
 
 from lib.kp_tools import *
+from lib.kp_autotune import KPGainTable
+from lib.kp_descent_planner import KPDescentPlanner
+from lib.kp_impact_predictor import KPImpactPredictor
+from lib.kp_input_shaping import KPInputShaper
+from lib.kp_radar import KPRadarMap
+from lib.kp_scheduler import KPTaskScheduler
+from lib.kp_terrain_cache import KPTerrainCache
 from lib.kp_mission_control import KPMissionProgram, KPMissionProgramsDatabase
 from lib.kp_serial_interface import KPSerialInterface
 from lib.logger import Logger
@@ -44,12 +51,22 @@ class KPFlightController(QtCore.QObject):
             krpc_stream_port=50001, 
             krpc_name="KerbalPie",
             vessel_name=None,
+            clock=None,
+            realtime=True,
+            vspeed_gain_table=None,
+            terrain_cache_dir=os.path.join('data', 'terrain'),
+            terrain_cache_altitude=2000.0,
+            input_shaping=None,
             **kwds):
         super(KPFlightController, self).__init__(**kwds)
         
+        # control clock
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.realtime = realtime
+        
         # thread variables
         self.terminate = False
-        self._timestamp = StateVariable(time.time())
+        self._timestamp = StateVariable(self.clock.time(), clock=self.clock)
         
         # KRPC client
         self._krpc = None
@@ -61,50 +78,110 @@ class KPFlightController(QtCore.QObject):
         self._krpc_game_scene = None
         self._vessel_to_control = vessel_name
         self._vessel_is_active = False
+        self._vessel_ready = False
 
         # remote control data
         self._rc_master_switch_engine    = False
         self._rc_master_switch_autopilot = False
         self._rc_button_stabilize        = False
-        self._rc_button_increment        = StateVariable(False)
-        self._rc_button_decrement        = StateVariable(False)
+        self._rc_button_presses          = KPRemoteControlState().button_presses
         self._rc_joystick_x              = 0.0
         self._rc_joystick_y              = 0.0
         self._rc_joystick_z              = 0.0
+        self._rc_source                  = None
+        self._rc_sequence                = 0
+        self._rc_frames_coalesced        = 0
+        self._input_shaper               = KPInputShaper(input_shaping)
+        
+        # telemetry downlink to the remote controller
+        self._downlink = None
         
         # flight data
         self._telemetry = {}
         
         # signals data
         self._signals = {}
-        self._signals_task = 0
-        self._signals_update_time = time.time()
-        self._radar_resolution = 30
+        self._signals_update_time = self.clock.time()
+        self._radar = KPRadarMap(resolution=30, element_spacing=0.5, sampling='adaptive')
+        self._terrain_cache = None
+        self._terrain_cache_dir = terrain_cache_dir
+        self._terrain_cache_altitude = terrain_cache_altitude     # meters above the terrain
+        self._impact_predictor = KPImpactPredictor()
         
         # flight automatic controls
-        self.ctrl_vertical_speed = QPidController(kp=0.181, ki=0.09, kd=0.005, output_min=0.0, output_max=1.0, set_point=0.0, name="Vertical Speed Controller", parent=self)
-        self.ctrl_altitude = QPidController(kp=1.5, ki=0.005, kd=0.005, output_min=-5.0, output_max=5.0, set_point=85.0, name="Altitude Controller", parent=self)
-        self.ctrl_attitude = QPidController(kp=1.5, ki=0.005, kd=0.005, output_min=0.0, output_max=5.0, set_point=0.0, name="Attitude Controller", parent=self)
+        self.ctrl_vertical_speed = QPidController(kp=0.181, ki=0.09, kd=0.005, output_min=0.0, output_max=1.0, set_point=0.0, name="Vertical Speed Controller", clock=self.clock, parent=self)
+        self.ctrl_altitude = QPidController(kp=1.5, ki=0.005, kd=0.005, output_min=-5.0, output_max=5.0, set_point=85.0, name="Altitude Controller", clock=self.clock, rate='lts', parent=self)
+        self.ctrl_attitude = QPidController(kp=1.5, ki=0.005, kd=0.005, output_min=0.0, output_max=5.0, set_point=0.0, name="Attitude Controller", clock=self.clock, parent=self)
         self.controllers = []
         self.controllers.append(self.ctrl_vertical_speed)
         self.controllers.append(self.ctrl_altitude)
         self.controllers.append(self.ctrl_attitude)
         self._kill_horizontal_velocity = StateVariable(False)
         
+        # cascaded control loops, each updated on its controller's scheduler
+        # tier; outer loops hand their output to inner loops through a slot
+        self._vspeed_setpoint_cmd = LatestValue()
+        self._control_loops = [
+            {
+                'controller'    : self.ctrl_altitude,
+                'programs'      : ('altitude_manual', 'altitude_auto'),
+                'input'         : 'vessel_mean_altitude',
+                'output'        : self._vspeed_setpoint_cmd,
+            },
+        ]
+        
+        # tuned vertical speed gains, from lib/kp_autotune.py
+        self._vspeed_gain_table = None
+        if vspeed_gain_table is not None and os.path.isfile(vspeed_gain_table):
+            self._vspeed_gain_table = KPGainTable.load(vspeed_gain_table)
+        
+        # descent profile planner
+        self._descent_planner = KPDescentPlanner()
+        
         # mission program
         self._mission_program = None
         
-        # timing data
-        self._scheduler_timings = {}
-        self._scheduler_timings['sts'] = StateVariable(0.0, int(1.0 / KPFlightController.sts_period + 0.5))
-        self._scheduler_timings['lts'] = StateVariable(0.0, int(1.0 / KPFlightController.lts_period + 0.5))
+        # task schedulers, each task with a time budget (seconds). Tasks that
+        # keep overrunning their budget are throttled, then demoted to the
+        # next slower scheduler.
+        self._xlts = KPTaskScheduler('XLTS', KPFlightController.xlts_period, KPFlightController.subsys)
+        self._lts = KPTaskScheduler('LTS', KPFlightController.lts_period, KPFlightController.subsys, demote_to=self._xlts)
+        self._sts = KPTaskScheduler('STS', KPFlightController.sts_period, KPFlightController.subsys, demote_to=self._lts)
+        self._schedulers = {
+            'sts'   : self._sts,
+            'lts'   : self._lts,
+            'xlts'  : self._xlts,
+        }
+        
+        self._sts.add_task('flight_scene', self._flight_scene_update, budget=0.005, critical=True)
+        self._sts.add_task('telemetry', self._if_vessel_ready(self._telemetry_update), budget=0.025, critical=True)
+        self._sts.add_task('remote_control', self._remote_control_update, budget=0.002, critical=True)
+        self._sts.add_task('control', self._if_vessel_ready(self._control_update), budget=0.010, critical=True)
+        self._lts.add_task('control_loops', self._if_vessel_ready(lambda: self._control_loops_update('lts')), budget=0.005, critical=True)
+        self._radar_task = self._lts.add_task('radar', self._if_vessel_ready(self._signals_update), budget=0.100)
+        self._lts.add_task('impact_prediction', self._if_vessel_ready(self._impact_prediction_update), budget=0.020)
+        self._xlts.add_task('krpc_heartbeat', self._krpc_heartbeat, budget=1.0, critical=True)
         
         # initialize data
         self._vessel_allow_engines   = StateVariable()
         self._vessel_allow_autopilot = StateVariable()
         self._vessel_body            = StateVariable()
         self._vessel_control_sas     = False
-        self._telemetry['surface_height_map'] = [[0.0 for x in range(self._radar_resolution)] for y in range(self._radar_resolution)]
+        self._telemetry['rc_frames_coalesced'] = 0
+        self._telemetry['radar_frame'] = None
+        self._telemetry['impact_latitude'] = None
+        self._telemetry['impact_longitude'] = None
+        self._telemetry['time_to_impact'] = None
+        self._telemetry['impact_slope'] = None
+        
+        # clock-driven schedulers, used instead of the Qt timers when not
+        # running in real time
+        current_time = self.clock.time()
+        self._clocked_schedulers = [
+            {'period': KPFlightController.sts_period,  'next_time': current_time, 'callback': self.short_term_processing},
+            {'period': KPFlightController.lts_period,  'next_time': current_time, 'callback': self.long_term_processing},
+            {'period': KPFlightController.xlts_period, 'next_time': current_time, 'callback': self.xlong_term_processing},
+        ]
         
         # initialize control timers
         self._short_term_scheduler = QTimer()
@@ -112,18 +189,77 @@ class KPFlightController(QtCore.QObject):
         self._xlong_term_scheduler = QTimer()
         
         self._short_term_scheduler.timeout.connect(self.short_term_processing)
-        self._short_term_scheduler.start(KPFlightController.sts_period * 1000.0)
-        
         self._long_term_scheduler.timeout.connect(self.long_term_processing)
-        self._long_term_scheduler.start(KPFlightController.lts_period * 1000.0)
-        
         self._xlong_term_scheduler.timeout.connect(self.xlong_term_processing)
-        self._xlong_term_scheduler.start(KPFlightController.xlts_period * 1000.0)
+        
+        if self.realtime:
+            self._short_term_scheduler.start(KPFlightController.sts_period * 1000.0)
+            self._long_term_scheduler.start(KPFlightController.lts_period * 1000.0)
+            self._xlong_term_scheduler.start(KPFlightController.xlts_period * 1000.0)
         
         
         
     # M E T H O D S 
     #===========================================================================
+    def step(self):
+        # run every scheduler that is due according to the control clock. With
+        # a SimulatedClock, offline runs can call this as fast as they like:
+        #
+        #   clock.advance(KPFlightController.sts_period)
+        #   flight_ctrl.step()
+        #
+        current_time = self.clock.time()
+        
+        for scheduler in self._clocked_schedulers:
+            if current_time >= scheduler['next_time']:
+                # skip any periods that were missed entirely
+                periods_due = int((current_time - scheduler['next_time']) / scheduler['period']) + 1
+                scheduler['next_time'] += periods_due * scheduler['period']
+                scheduler['callback']()
+        
+        
+    def register_task(self, scheduler, name, callback, budget, critical=False):
+        # add a task to the 'sts', 'lts' or 'xlts' scheduler
+        return self._schedulers[scheduler].add_task(name, callback, budget, critical)
+        
+        
+    def unregister_task(self, name):
+        for scheduler in self._schedulers.values():
+            if scheduler.remove_task(name) is not None:
+                return True
+        return False
+        
+        
+    def set_downlink(self, downlink):
+        # LatestValue slot the telemetry downlink is sent from
+        self._downlink = downlink
+        
+        
+    def set_rc_source(self, rc_state):
+        # LatestValue slot holding the newest KPRemoteControlState
+        self._rc_source = rc_state
+        self._rc_sequence = rc_state.get_with_sequence()[0] if rc_state is not None else 0
+
+        # presses before the source was set are not acted on
+        current_state = rc_state.get() if rc_state is not None else None
+        self._rc_button_presses = current_state.button_presses if current_state is not None else KPRemoteControlState().button_presses
+        
+        
+    def set_input_shaping(self, axis, axis_shaping):
+        # compiles the axis's lookup table in the calling thread; the remote
+        # control task picks it up on its next frame
+        self._input_shaper.configure(axis, axis_shaping)
+        
+        
+    def set_clock(self, clock):
+        self.clock = clock
+        self._timestamp = StateVariable(self.clock.time(), clock=self.clock)
+        for ctrl in self.controllers:
+            ctrl.setClock(self.clock)
+        
+        current_time = self.clock.time()
+        for scheduler in self._clocked_schedulers:
+            scheduler['next_time'] = current_time
         
         
     # O V E R R I D E   M E T H O D S 
@@ -144,6 +280,48 @@ class KPFlightController(QtCore.QObject):
         
     # P R I V A T E   M E T H O D S 
     #===========================================================================
+    def _if_vessel_ready(self, callback):
+        # wraps a task so it only runs while the vessel telemetry is set up
+        def task():
+            if self._vessel_ready:
+                callback()
+        return task
+        
+        
+    def _set_vspeed_auto_gains(self):
+        # use the tuned gain table when available, otherwise fall back to
+        # fixed ratios of the ultimate gain
+        if self._vspeed_gain_table is not None:
+            twr = self._telemetry['vessel_max_thrust'] / self._telemetry['vessel_weight']
+            (kp, ki, kd) = self._vspeed_gain_table.lookup(twr, self._telemetry['vessel_body_gravity'])
+        else:
+            ku = self._telemetry['vessel_weight'] / self._telemetry['vessel_max_thrust']
+            (kp, ki, kd) = (ku * 0.70, ku / 3.0, ku / 50.0)
+        
+        self.ctrl_vertical_speed.setProportionalGain(kp)
+        self.ctrl_vertical_speed.setIntegralGain(ki)
+        self.ctrl_vertical_speed.setDerivativeGain(kd)
+        
+        
+    def _set_vspeed_setpoint_from_cascade(self):
+        # take the latest command from the outer loop, if it has run yet
+        vspeed_cmd = self._vspeed_setpoint_cmd.get()
+        if vspeed_cmd is not None:
+            self.ctrl_vertical_speed.setSetpoint(vspeed_cmd)
+        
+        
+    def _control_loops_update(self, rate):
+        # update the cascaded loops that run on the given scheduler tier
+        if not self._vessel_allow_autopilot.get() or self._mission_program is None:
+            return
+        
+        if self._telemetry.get('vessel_max_thrust', 0.0) <= 0.0:
+            return
+        
+        for loop in self._control_loops:
+            if loop['controller'].rate == rate and self._mission_program.id in loop['programs']:
+                loop['output'].put(loop['controller'].update(self._telemetry[loop['input']]))
+        
 
     #=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%#
     #=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%#
@@ -189,11 +367,35 @@ class KPFlightController(QtCore.QObject):
         self._vessel_body_reff          = self._vessel_body.get().reference_frame
         self._vessel_flight_bdy         = self._vessel.flight(self._vessel_body_reff)
         self._vessel_flight_srf         = self._vessel.flight(self._vessel_surface_reff)
-
+        
+        # terrain lookups read through a persistent cache for this body
+        body_radius = self._vessel_body.get().equatorial_radius
+        self._radar.set_body(body_radius)
+        if self._terrain_cache is None or self._terrain_cache.body_name != self._vessel_body_name:
+            self._close_terrain_cache()
+            self._terrain_cache = KPTerrainCache(
+                self._vessel_body_name,
+                body_radius,
+                self._vessel_body.get().surface_height,
+                cache_dir=self._terrain_cache_dir,
+                resolution=self._radar.element_spacing)
+
+        # impact predictions use the body frame; find which way its z axis
+        # points to convert positions to longitudes
+        east_sign = 1.0 if self._vessel_body.get().surface_position(0.0, 90.0, self._vessel_body_reff)[2] > 0.0 else -1.0
+        self._impact_predictor.set_body(
+            body_radius,
+            self._space_g * self._vessel_body_mass,
+            self._radar.element_spacing,
+            terrain_peek=self._terrain_cache.peek_cells,
+            east_sign=east_sign)
         
         # add telemetry streams
         self._space_ut                  = self._krpc.add_stream(getattr, self._krpc.space_center, 'ut')
+        if isinstance(self.clock, GameClock):
+            self.clock.set_source(self._space_ut)
         self._vessel_position_bdy       = self._krpc.add_stream(self._vessel.position, self._vessel_body_reff)
+        self._vessel_velocity_bdy       = self._krpc.add_stream(self._vessel.velocity, self._vessel_body_reff)
         self._vessel_mass               = self._krpc.add_stream(getattr, self._vessel, 'mass')
         self._vessel_thrust             = self._krpc.add_stream(getattr, self._vessel, 'thrust')
         self._vessel_max_thrust         = self._krpc.add_stream(getattr, self._vessel, 'max_thrust')
@@ -228,9 +430,26 @@ class KPFlightController(QtCore.QObject):
         self._log('Tracking vessel "{:s}"'.format(self._vessel.name))
 
 
+    def _terrain_sampler(self):
+        # terrain is only cached near the surface; higher up, the ground
+        # track crosses tiles too quickly for them to be used again
+        if self._telemetry['vessel_surface_altitude'] <= self._terrain_cache_altitude:
+            return self._terrain_cache.height
+        return self._terrain_cache.lookup
+
+
+    def _close_terrain_cache(self):
+        if self._terrain_cache is not None:
+            self._terrain_cache.close()
+            self._terrain_cache = None
+
+
     def _remove_telemetry(self):
+        if isinstance(self.clock, GameClock):
+            self.clock.set_source(None)
         self._space_ut.remove()
         self._vessel_position_bdy.remove()
+        self._vessel_velocity_bdy.remove()
         self._vessel_mass.remove()
         self._vessel_thrust.remove()
         self._vessel_max_thrust.remove()
@@ -265,6 +484,7 @@ class KPFlightController(QtCore.QObject):
         self._telemetry['vessel_body_name']         = self._vessel_body_name
         
         self._telemetry['vessel_position_bdy']      = self._vessel_position_bdy()
+        self._telemetry['vessel_velocity_bdy']      = self._vessel_velocity_bdy()
         self._telemetry['vessel_vertical_speed']    = self._vessel_vertical_speed()
         self._telemetry['vessel_rotation']          = self._vessel_rotation()
         self._telemetry['vessel_mass']              = self._vessel_mass()
@@ -275,7 +495,7 @@ class KPFlightController(QtCore.QObject):
         self._telemetry['vessel_surface_altitude']  = self._vessel_surface_altitude()
         self._telemetry['vessel_latitude']          = self._vessel_latitude()
         self._telemetry['vessel_longitude']         = self._vessel_longitude()
-        self._telemetry['vessel_surface_height']    = self._vessel_body.get().surface_height(
+        self._telemetry['vessel_surface_height']    = self._terrain_sampler()(
             self._telemetry['vessel_latitude'],
             self._telemetry['vessel_longitude'])
         
@@ -297,9 +517,11 @@ class KPFlightController(QtCore.QObject):
         vessel_to_east_vec = self._krpc.space_center.transform_direction((0,0,5), self._vessel.surface_reference_frame, self._vessel_body_reff)
         offset_vessel_to_east_vec = vector_add(self._telemetry['vessel_position_bdy'], vessel_to_east_vec)
 
-        vessel_velocity_rel_to_body = self._vessel.velocity(self._vessel_body_reff)
+        vessel_velocity_rel_to_body = self._telemetry['vessel_velocity_bdy']
         hrz_velocity_north = vector_dot_product(vessel_velocity_rel_to_body, vector_normalize(vessel_to_north_vec))
         hrz_velocity_east = vector_dot_product(vessel_velocity_rel_to_body, vector_normalize(vessel_to_east_vec))
+        self._telemetry['vessel_velocity_north'] = hrz_velocity_north
+        self._telemetry['vessel_velocity_east'] = hrz_velocity_east
         hrz_velocity = vector_project_onto_plane(vessel_velocity_rel_to_body, self._telemetry['vessel_position_bdy'])
         hrz_velocity_mag = vector_length(hrz_velocity)
         hrz_velocity_norm = vector_normalize(hrz_velocity)
@@ -326,6 +548,16 @@ class KPFlightController(QtCore.QObject):
         print("N: {:7.3f}, E: {:7.3f}, a = {:7.3f}".format(hrz_velocity_north, hrz_velocity_east, math.degrees(angle)))
         '''
         
+        # hand the newest values to the downlink, in telemetry message order
+        if self._downlink is not None:
+            self._downlink.put((
+                self._telemetry['vessel_mean_altitude'],
+                self._telemetry['vessel_surface_altitude'],
+                self._telemetry['vessel_vertical_speed'],
+                self.ctrl_vertical_speed._pid.set_point,
+                self._telemetry['vessel_throttle'],
+                self._mission_program.num if self._mission_program is not None and self._mission_program.num is not None else 0xFF))
+        
         # finish update
         self.telemetry_updated.emit(self._telemetry)
         
@@ -341,6 +573,39 @@ class KPFlightController(QtCore.QObject):
     #=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%=%#
         
         
+    def _remote_control_update(self):
+        if self._rc_source is None:
+            return
+        
+        # only the newest state is used; count the ones it replaced
+        (sequence, rc_state) = self._rc_source.get_with_sequence()
+        if sequence == self._rc_sequence or rc_state is None:
+            return
+        self._rc_frames_coalesced += sequence - self._rc_sequence - 1
+        self._rc_sequence = sequence
+        self._telemetry['rc_frames_coalesced'] = self._rc_frames_coalesced
+
+        # register master switches
+        self._rc_master_switch_engine    = rc_state.btn_switch_red
+        self._rc_master_switch_autopilot = rc_state.btn_switch_blue
+
+        # map joystick values to [-1.0, 1.0] through the shaping tables
+        self._rc_joystick_x = self._input_shaper.shape('joystick_x', rc_state.joystick_x)
+        self._rc_joystick_y = self._input_shaper.shape('joystick_y', rc_state.joystick_y)
+        self._rc_joystick_z = self._input_shaper.shape('joystick_z', rc_state.joystick_z)
+
+        self._rc_button_stabilize = rc_state.btn_joystick
+
+        # control vertical speed, one step per rocker press (bits 4 and 5)
+        # since the last state read, including presses released before this
+        # tick
+        increments = rc_state.button_presses[4] - self._rc_button_presses[4]
+        decrements = rc_state.button_presses[5] - self._rc_button_presses[5]
+        if increments != decrements:
+            self.ctrl_vertical_speed.setSetpoint(self.ctrl_vertical_speed._pid.set_point + 0.5 * (increments - decrements))
+        self._rc_button_presses = rc_state.button_presses
+        
+        
     def _control_update(self):
 
         # determine master engine control
@@ -364,6 +629,9 @@ class KPFlightController(QtCore.QObject):
         # determine mission program control
         if self._vessel_allow_autopilot.get() and self._mission_program is not None:
             mp_id = self._mission_program.id
+            
+            # cascaded loops that run at the STS rate
+            self._control_loops_update('sts')
 
     
             if mp_id == 'full_manual':
@@ -379,10 +647,7 @@ class KPFlightController(QtCore.QObject):
             elif mp_id == 'vspeed_auto':
                 if self._telemetry['vessel_max_thrust'] > 0.0:
                     # set control gains
-                    ku = self._telemetry['vessel_weight'] / self._telemetry['vessel_max_thrust']
-                    self.ctrl_vertical_speed.setProportionalGain(ku * 0.70)
-                    self.ctrl_vertical_speed.setIntegralGain(ku / 3.0)
-                    self.ctrl_vertical_speed.setDerivativeGain(ku / 50.0)
+                    self._set_vspeed_auto_gains()
                     
                     throttle_cmd = self.ctrl_vertical_speed.update(self._telemetry['vessel_vertical_speed'])
                     self._vessel_control.throttle = throttle_cmd
@@ -390,8 +655,7 @@ class KPFlightController(QtCore.QObject):
             # Control altitude without automatic tuning of controller gains
             elif mp_id == 'altitude_manual':
                 if self._telemetry['vessel_max_thrust'] > 0.0:
-                    vspeed_cmd = self.ctrl_altitude.update(self._telemetry['vessel_mean_altitude'])
-                    self.ctrl_vertical_speed.setSetpoint(vspeed_cmd)
+                    self._set_vspeed_setpoint_from_cascade()
                     
                     throttle_cmd = self.ctrl_vertical_speed.update(self._telemetry['vessel_vertical_speed'])
                     self._vessel_control.throttle = throttle_cmd
@@ -399,14 +663,9 @@ class KPFlightController(QtCore.QObject):
             # Control altitude with automatic tuning of speed controller gains
             elif mp_id == 'altitude_auto':
                 if self._telemetry['vessel_max_thrust'] > 0.0:
-                    vspeed_cmd = self.ctrl_altitude.update(self._telemetry['vessel_mean_altitude'])
-                    
                     # set control gains
-                    ku = self._telemetry['vessel_weight'] / self._telemetry['vessel_max_thrust']
-                    self.ctrl_vertical_speed.setProportionalGain(ku * 0.70)
-                    self.ctrl_vertical_speed.setIntegralGain(ku / 3.0)
-                    self.ctrl_vertical_speed.setDerivativeGain(ku / 50.0)
-                    self.ctrl_vertical_speed.setSetpoint(vspeed_cmd)
+                    self._set_vspeed_auto_gains()
+                    self._set_vspeed_setpoint_from_cascade()
                     throttle_cmd = self.ctrl_vertical_speed.update(self._telemetry['vessel_vertical_speed'])
                     self._vessel_control.throttle = throttle_cmd
                 
@@ -414,11 +673,14 @@ class KPFlightController(QtCore.QObject):
             elif mp_id == 'controlled_descent':
                 if self._telemetry['vessel_max_thrust'] > 0.0:
                     # set control gains
-                    ku = self._telemetry['vessel_weight'] / self._telemetry['vessel_max_thrust']
-                    self.ctrl_vertical_speed.setProportionalGain(ku * 0.70)
-                    self.ctrl_vertical_speed.setIntegralGain(ku / 3.0)
-                    self.ctrl_vertical_speed.setDerivativeGain(ku / 50.0)
-                    self.ctrl_vertical_speed.setSetpoint(self._telemetry['vessel_surface_altitude'] / -12.0 - 1.0)
+                    self._set_vspeed_auto_gains()
+                    
+                    # follow the precomputed descent profile
+                    self._descent_planner.update(
+                        self._telemetry['vessel_mass'],
+                        self._telemetry['vessel_max_thrust'],
+                        self._telemetry['vessel_body_gravity'])
+                    self.ctrl_vertical_speed.setSetpoint(self._descent_planner.vertical_speed(self._telemetry['vessel_surface_altitude']))
                 
                     throttle_cmd = self.ctrl_vertical_speed.update(self._telemetry['vessel_vertical_speed'])
                     self._vessel_control.throttle = throttle_cmd
@@ -427,10 +689,7 @@ class KPFlightController(QtCore.QObject):
             elif mp_id == 'hrz_stabilize':
                 if self._telemetry['vessel_max_thrust'] > 0.0:
                     # set control gains
-                    ku = self._telemetry['vessel_weight'] / self._telemetry['vessel_max_thrust']
-                    self.ctrl_vertical_speed.setProportionalGain(ku * 0.70)
-                    self.ctrl_vertical_speed.setIntegralGain(ku / 3.0)
-                    self.ctrl_vertical_speed.setDerivativeGain(ku / 50.0)
+                    self._set_vspeed_auto_gains()
                     
                     throttle_cmd = self.ctrl_vertical_speed.update(self._telemetry['vessel_vertical_speed'])
                     self._vessel_control.throttle = throttle_cmd
@@ -465,83 +724,43 @@ class KPFlightController(QtCore.QObject):
     
         if 'vessel_latitude' in self._telemetry.keys() and 'vessel_longitude' in self._telemetry.keys():
             
-            '''
-            for y in range(s):
-                longitude = self._telemetry['vessel_longitude'] + float(y - s / 2) * delta_lat
-                for x in range(s):
-                    latitude = self._telemetry['vessel_latitude'] + float(x - s / 2) * delta_lat
-                    #self._telemetry['surface_height_map'][x][y] = \
-                    #    self._vessel_body().surface_height(latitude, longitude) - self._telemetry['vessel_surface_height']
-                    self._telemetry['surface_height_map'][x][y] = 0.0
-            '''
-            
-            
-            #radar_element_spacing = 60000.0 # meters  60000.0 = can see whole map
-            radar_element_spacing = 0.5
+            # scroll the radar map with the vessel, and sample as many of the
+            # cells that are not known yet as fit in the remaining budget
+            sweep_completed = self._radar.update(
+                self._telemetry['vessel_latitude'],
+                self._telemetry['vessel_longitude'],
+                self._terrain_sampler(),
+                time_budget=self._radar_task.time_remaining() * 0.8,
+                velocity=(self._telemetry['vessel_velocity_north'], self._telemetry['vessel_velocity_east']))
+            self._telemetry['terrain_cache_hit_ratio'] = self._terrain_cache.hit_ratio()
             
-            body_to_vessel_distance = math.sqrt( \
-                self._telemetry['vessel_position_bdy'][0] ** 2 + \
-                self._telemetry['vessel_position_bdy'][1] ** 2 + \
-                self._telemetry['vessel_position_bdy'][2] ** 2 )
-            delta_lat = math.degrees(radar_element_spacing / body_to_vessel_distance)
-            #print("delta_lat = {:.20f}".format(delta_lat))
-            
-            num_radar_tasks = self._radar_resolution * self._radar_resolution
-            num_radar_tasks_to_execute = 60
-            
-            for i in range(num_radar_tasks_to_execute):
-            
-                if self._signals_task >= 0 and self._signals_task < num_radar_tasks:
-                    x_idx = int(self._signals_task % self._radar_resolution)
-                    y_idx = int(self._signals_task / self._radar_resolution)
-                    
-                    latitude = self._telemetry['vessel_latitude'] + float(y_idx - self._radar_resolution / 2) * delta_lat
-                    longitude = self._telemetry['vessel_longitude'] + float(x_idx - self._radar_resolution / 2) * delta_lat
-                    
-                    latitude = clamp(-89.9, latitude, 89.9)
-                    
-                    self._telemetry['surface_height_map'][y_idx][x_idx] = \
-                        self._telemetry['vessel_surface_height'] - self._vessel_body.get().surface_height(latitude, longitude)
-                        
-                self._signals_task += 1
-                if self._signals_task >= num_radar_tasks:
-                    self._signals_task = 0
-                    
-                    
-                    #print("Span: {:.3f} m  ({:.6f} deg)".format(radar_element_spacing * self._radar_resolution,
-                    #    delta_lat * self._radar_resolution))
-                    for y in range(len(self._telemetry['surface_height_map']), 0, -1):
-                        #print("{:d}".format(y - 1))
-                        alt_line = []
-                        for x in range(len(self._telemetry['surface_height_map'][y - 1])):
-                            alt_line.append('{:5.1f}'.format(self._telemetry['surface_height_map'][y - 1][x]))
-                        #print(' '.join(alt_line))
-                    
-                    
-                    #for a in self._telemetry['surface_height_map'][int(self._radar_resolution / 2)]:
-                        #print("{:.3f}".format(a))
-                
+            # publish completed maps as immutable frames
+            if sweep_completed:
+                self._telemetry['radar_frame'] = self._radar.publish(self._telemetry['vessel_surface_height'])
         
     
-    def _krpc_heartbeat(self):
-        try:
-            status = self._krpc.krpc.get_status().version
-            
-        except ConnectionAbortedError as abort:
-            self._log_exception('KRPC connection aborted', abort)
-            self.krpc_disconnect()
-        except ConnectionResetError as reset:
-            self._log_exception('KRPC connection reset by host', reset)
-            self.krpc_disconnect()
-
-
-
-    # S L O T S 
-    #===========================================================================
-    @pyqtSlot()
-    def short_term_processing(self):
-        start_time = time.time()
-        #--
+    def _impact_prediction_update(self):
+        # engines keep their current thrust along the vessel's long axis
+        thrust_direction = quaternion_rotate(self._telemetry['vessel_rotation'], (0.0, 1.0, 0.0))
+        thrust_acceleration = vector_scale(thrust_direction, self._telemetry['vessel_thrust'] / self._telemetry['vessel_mass'])
+        
+        impact = self._impact_predictor.predict(
+            self._telemetry['vessel_position_bdy'],
+            self._telemetry['vessel_velocity_bdy'],
+            thrust_acceleration,
+            self._telemetry['vessel_latitude'],
+            self._telemetry['vessel_longitude'],
+            self._telemetry['vessel_surface_height'],
+            radar_frame=self._telemetry['radar_frame'])
+        
+        self._telemetry['impact_latitude'] = impact.latitude if impact is not None else None
+        self._telemetry['impact_longitude'] = impact.longitude if impact is not None else None
+        self._telemetry['time_to_impact'] = impact.time_to_impact if impact is not None else None
+        self._telemetry['impact_slope'] = impact.slope if impact is not None else None
+        
+    
+    def _flight_scene_update(self):
+        self._vessel_ready = False
         
         if self.krpc_is_connected:
 
@@ -556,45 +775,52 @@ class KPFlightController(QtCore.QObject):
                     self._setup_telemetry()
 
                 else:
-                    self._telemetry_update()
-                    self._control_update()
-                    pass
+                    self._vessel_ready = True
 
             else:
                 # otherwise, unset the active vessel and telemetry
                 self._vessel_is_active = False
         
-        #--
-        process_time = time.time() - start_time
-        self._scheduler_timings['sts'].update(process_time)
-        self._telemetry['sts_time'] = self._scheduler_timings['sts'].get_mean()
-        if process_time > KPFlightController.sts_period:
-            self._log_warning('STS overrun: {:.1f} ms, overrun by {:.1f} ms'.format(
-                process_time * 1000.0, (process_time - KPFlightController.sts_period) * 1000.0))
+    
+    def _krpc_heartbeat(self):
+        if not self.krpc_is_connected:
+            return
         
+        try:
+            status = self._krpc.krpc.get_status().version
             
+        except ConnectionAbortedError as abort:
+            self._log_exception('KRPC connection aborted', abort)
+            self.krpc_disconnect()
+        except ConnectionResetError as reset:
+            self._log_exception('KRPC connection reset by host', reset)
+            self.krpc_disconnect()
+
+
+
+    # S L O T S 
+    #===========================================================================
+    @pyqtSlot()
+    def short_term_processing(self):
+        self._sts.run()
+        self._telemetry['sts_time'] = self._sts.timing.get_mean()
         
+            
     @pyqtSlot()
     def long_term_processing(self):
-        start_time = time.time()
-        #--
+        self._lts.run()
+        self._telemetry['lts_time'] = self._lts.timing.get_mean()
         
-        if self.krpc_is_connected and self._vessel_is_active:
-            self._signals_update()
-        
-        #--
-        process_time = time.time() - start_time
-        self._scheduler_timings['lts'].update(process_time)
-        self._telemetry['lts_time'] = self._scheduler_timings['lts'].get_mean()
-        if process_time > KPFlightController.lts_period:
-            self._log_warning('LTS overrun: {:.1f} ms, overrun by {:.1f} ms'.format(
-                process_time * 1000.0, (process_time - KPFlightController.lts_period) * 1000.0))
+        # per-task cost across all schedulers
+        task_times = {}
+        for scheduler in self._schedulers.values():
+            task_times.update(scheduler.task_timings())
+        self._telemetry['task_times'] = task_times
         
 
     @pyqtSlot()
     def xlong_term_processing(self):
-        if self.krpc_is_connected:
-            self._krpc_heartbeat()
+        self._xlts.run()
         
     
     @pyqtSlot()
@@ -602,11 +828,15 @@ class KPFlightController(QtCore.QObject):
         while not self.terminate:
 
             # record the time
-            self._timestamp.update(time.time())
+            self._timestamp.update(self.clock.time())
             
             # service Qt events
             QCoreApplication.processEvents()
             
+            # drive the schedulers from the clock when not using the timers
+            if not self.realtime:
+                self.step()
+            
             
         # thread termination
         self.krpc_disconnect()
@@ -619,6 +849,7 @@ class KPFlightController(QtCore.QObject):
 
         # set the new active mission program
         self._mission_program = program
+        self._vspeed_setpoint_cmd.clear()
         
         # set mission program settings
         self.ctrl_vertical_speed.setSetpointEditable(self._mission_program.settings['vertical_speed_controller_setpoint_editable'])
@@ -648,38 +879,11 @@ class KPFlightController(QtCore.QObject):
     @pyqtSlot()
     def krpc_disconnect(self):
         if self._krpc is not None:
+            if isinstance(self.clock, GameClock):
+                self.clock.set_source(None)
+            self._close_terrain_cache()
+            self._vessel_is_active = False
             self._krpc.close()
             self.krpc_is_connected = False
             self.krpc_disconnected.emit()
             self._log('Disconnected from KRPC server')
-
-
-    @pyqtSlot(KPRemoteControlState)
-    def rc_command_received(self, rc_cmd):
-
-        # register master switches
-        self._rc_master_switch_engine    = rc_cmd.btn_switch_red
-        self._rc_master_switch_autopilot = rc_cmd.btn_switch_blue
-
-        # map joystick values to [-1.0, 1.0]
-        joystick_x = (float(rc_cmd.joystick['x']) / 1023.0 - 0.5) * 2.0
-        joystick_y = (float(rc_cmd.joystick['y']) / 1023.0 - 0.5) * -2.0
-        joystick_z = (float(rc_cmd.joystick['z']) / 1023.0 - 0.5) * -2.0
-
-        # filter out dead-zone
-        self._rc_joystick_x = 0.0 if (joystick_x > -0.04 and joystick_x < 0.04) else joystick_x
-        self._rc_joystick_y = 0.0 if (joystick_y > -0.04 and joystick_y < 0.04) else joystick_y
-        self._rc_joystick_z = 0.0 if (joystick_z > -0.04 and joystick_z < 0.04) else joystick_z
-
-        self._rc_button_stabilize = rc_cmd.btn_joystick
-        self._rc_button_increment.update(rc_cmd.btn_rocker_up)
-        self._rc_button_decrement.update(rc_cmd.btn_rocker_down)
-
-        # control vertical speed
-        if self._rc_button_decrement.has_changed(to_value=True):
-            self.ctrl_vertical_speed.setSetpoint(self.ctrl_vertical_speed._pid.set_point - 0.5)
-
-        if self._rc_button_increment.has_changed(to_value=True):
-            self.ctrl_vertical_speed.setSetpoint(self.ctrl_vertical_speed._pid.set_point + 0.5)
-            
-
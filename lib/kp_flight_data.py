@@ -53,6 +53,10 @@ class KPFlightDataModel(QtCore.QAbstractTableModel):
         'vessel_latitude',
         'vessel_longitude',
         'vessel_surface_height',
+        'impact_latitude',
+        'impact_longitude',
+        'time_to_impact',
+        'impact_slope',
         'sts_time',
         'lts_time',
     ]
@@ -87,6 +91,10 @@ class KPFlightDataModel(QtCore.QAbstractTableModel):
             ['Latitude',          'deg',      0.0],
             ['Longitude',         'deg',      0.0],
             ['Surface Height',    'm',        0.0],
+            ['Impact Latitude',   'deg',      ''],
+            ['Impact Longitude',  'deg',      ''],
+            ['Time to Impact',    's',        ''],
+            ['Impact Slope',      'deg',      ''],
             ['STS Timing',        's',        0.0],
             ['LTS Timing',        's',        0.0],
         ]
@@ -104,6 +112,8 @@ class KPFlightDataModel(QtCore.QAbstractTableModel):
             # handle special formatting
             if parameter == 'vessel_rotation':
                 value = "({:.3f},{:.3f},{:.3f},{:.3f})".format(value[0], value[1], value[2], value[3])
+            elif value is None:
+                value = ''
             
             self.setData(model_index, QVariant(value), Qt.EditRole)
         
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import math
+
+import numpy as np
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Predicted impact
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+class KPImpactPrediction():
+
+    __slots__ = ('latitude', 'longitude', 'time_to_impact', 'slope', 'terrain_known')
+
+    def __init__(self, latitude, longitude, time_to_impact, slope, terrain_known):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.time_to_impact = time_to_impact        # seconds
+        self.slope = slope                          # degrees, None if unknown
+        self.terrain_known = terrain_known          # False if the impact point terrain was assumed
+
+
+
+#--- Impact point predictor
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Propagates the vessel's trajectory in the body reference frame under point
+# mass gravity and a constant thrust acceleration, and intersects it with the
+# terrain. The trajectory is integrated in batches of steps: the acceleration
+# is evaluated once at the start of a batch, and the positions of all of the
+# batch's steps are computed in one NumPy expression. The rotation of the
+# body frame (Coriolis and centrifugal terms) is neglected, which is small
+# over the few minutes a landing prediction covers.
+#
+# Terrain heights come from the latest radar frame where it covers the
+# trajectory, then from the terrain cache (without sampling the body). Where
+# neither knows the terrain, the surface height under the vessel is assumed.
+class KPImpactPredictor():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, time_step=0.1, batch_steps=50, max_time=120.0):
+        self.time_step = time_step          # seconds
+        self.batch_steps = batch_steps
+        self.max_time = max_time            # prediction horizon (seconds)
+
+        self._body_radius = None
+        self._mu = None
+        self._east_sign = 1.0
+        self._cell_deg = None
+        self._terrain_spacing = None
+        self._terrain_peek = None
+
+        self._batch_times = np.arange(1, batch_steps + 1) * time_step
+
+
+    # M E T H O D S
+    #===========================================================================
+    def set_body(self, body_radius, gravitational_parameter, terrain_spacing, terrain_peek=None, east_sign=1.0):
+        # east_sign is +1.0 if longitude increases towards the body frame's
+        # +z axis, -1.0 otherwise. terrain_peek(lat_cells, lon_cells) returns
+        # the known heights of arrays of terrain cells, NaN where unknown
+        self._body_radius = body_radius
+        self._mu = gravitational_parameter
+        self._east_sign = east_sign
+        self._terrain_spacing = terrain_spacing
+        self._cell_deg = math.degrees(terrain_spacing / body_radius)
+        self._terrain_peek = terrain_peek
+
+
+    def predict(self, position, velocity, thrust_acceleration, latitude, longitude, fallback_height, radar_frame=None):
+        # position and velocity in the body reference frame, thrust
+        # acceleration as a vector in the same frame. Returns a
+        # KPImpactPrediction, or None if the vessel does not reach the
+        # terrain within the prediction horizon.
+        if self._body_radius is None:
+            return None
+
+        p = np.array(position, dtype=np.float64)
+        v = np.array(velocity, dtype=np.float64)
+        thrust = np.array(thrust_acceleration, dtype=np.float64)
+        longitude_ref = math.atan2(p[2], p[0])
+
+        # already on the ground
+        (heights, known) = self._terrain_heights(np.array([latitude]), np.array([longitude]), fallback_height, radar_frame)
+        clearance = np.linalg.norm(p) - (self._body_radius + heights[0])
+        if clearance <= 0.0:
+            return self._impact(latitude, longitude, 0.0, bool(known[0]), radar_frame)
+
+        t = 0.0
+        times = self._batch_times[:, None]
+        previous = (clearance, latitude, longitude)
+
+        while t < self.max_time:
+            r = np.linalg.norm(p)
+            a = p * (-self._mu / r ** 3) + thrust
+
+            # every step of the batch, assuming a constant acceleration
+            positions = p + v * times + (0.5 * a) * times ** 2
+            radii = np.linalg.norm(positions, axis=1)
+
+            latitudes = np.degrees(np.arcsin(positions[:, 1] / radii))
+            delta_longitudes = np.arctan2(positions[:, 2], positions[:, 0]) - longitude_ref
+            delta_longitudes = (delta_longitudes + math.pi) % (2.0 * math.pi) - math.pi
+            longitudes = longitude + self._east_sign * np.degrees(delta_longitudes)
+
+            (heights, known) = self._terrain_heights(latitudes, longitudes, fallback_height, radar_frame)
+            clearances = radii - (self._body_radius + heights)
+
+            # first step below the terrain, interpolated from the step before
+            below = np.flatnonzero(clearances <= 0.0)
+            if len(below) > 0:
+                i = int(below[0])
+                (c0, lat0, lon0) = (clearances[i - 1], latitudes[i - 1], longitudes[i - 1]) if i > 0 else previous
+                fraction = c0 / (c0 - clearances[i])
+
+                return self._impact(
+                    lat0 + (latitudes[i] - lat0) * fraction,
+                    lon0 + (longitudes[i] - lon0) * fraction,
+                    t + (i + fraction) * self.time_step,
+                    bool(known[i]),
+                    radar_frame)
+
+            previous = (clearances[-1], latitudes[-1], longitudes[-1])
+            p = positions[-1]
+            v = v + a * self._batch_times[-1]
+            t += self._batch_times[-1]
+
+        return None
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _impact(self, latitude, longitude, time_to_impact, terrain_known, radar_frame):
+        return KPImpactPrediction(
+            float(latitude),
+            float(longitude),
+            float(time_to_impact),
+            self._slope(latitude, longitude, radar_frame),
+            terrain_known)
+
+
+    def _slope(self, latitude, longitude, radar_frame):
+        # central differences over the neighbouring terrain cells
+        d = self._cell_deg
+        latitudes = np.array([latitude + d, latitude - d, latitude, latitude])
+        longitudes = np.array([longitude, longitude, longitude + d, longitude - d])
+        (heights, known) = self._terrain_heights(latitudes, longitudes, np.nan, radar_frame)
+
+        if not known.all():
+            return None
+
+        north_distance = 2.0 * self._terrain_spacing
+        east_distance = north_distance * max(math.cos(math.radians(latitude)), 1.0e-6)
+        gradient_north = (heights[0] - heights[1]) / north_distance
+        gradient_east = (heights[2] - heights[3]) / east_distance
+
+        return math.degrees(math.atan(math.hypot(gradient_north, gradient_east)))
+
+
+    def _terrain_heights(self, latitudes, longitudes, fallback_height, radar_frame):
+        # terrain heights, and which of them are known rather than assumed
+        heights = np.full(len(latitudes), np.nan)
+
+        lat_cells = np.floor(latitudes / self._cell_deg).astype(np.int64)
+        lon_cells = np.floor(longitudes / self._cell_deg).astype(np.int64)
+
+        if radar_frame is not None and radar_frame.cell_deg == self._cell_deg:
+            (rows, columns) = radar_frame.heights.shape
+            y = lat_cells - radar_frame.origin[0]
+            x = lon_cells - radar_frame.origin[1]
+            inside = (y >= 0) & (y < rows) & (x >= 0) & (x < columns)
+            heights[inside] = radar_frame.heights[y[inside], x[inside]]
+
+        if self._terrain_peek is not None:
+            unknown = np.flatnonzero(np.isnan(heights))
+            if len(unknown) > 0:
+                heights[unknown] = self._terrain_peek(lat_cells[unknown], lon_cells[unknown])
+
+        known = ~np.isnan(heights)
+        heights[~known] = fallback_height
+        return (heights, known)
+
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+from lib.kp_tools import clamp
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Joystick axis shaping
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Maps a raw 10-bit joystick value to [-1.0, 1.0]:
+#
+#   calibration   raw minimum, center and maximum, each half scaled separately
+#   invert        reverses the axis
+#   dead_zone     values closer to 0.0 than this become 0.0
+#   expo          blends in a cubic curve: (1 - expo) * v + expo * v^3
+#   trim          offset added to the shaped value
+#
+# The defaults are a linear mapping with a 0.04 dead zone.
+class KPAxisShaping():
+
+    raw_size = 1024
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, invert=False, dead_zone=0.04, expo=0.0, trim=0.0, calibration=(0.0, 511.5, 1023.0)):
+        self.invert = invert
+        self.dead_zone = dead_zone
+        self.expo = expo
+        self.trim = trim
+        self.calibration = tuple(float(value) for value in calibration)
+
+
+    # M E T H O D S
+    #===========================================================================
+    def shape(self, raw):
+        (raw_min, raw_center, raw_max) = self.calibration
+
+        if raw < raw_center:
+            value = (raw - raw_center) / max(raw_center - raw_min, 1.0e-6)
+        else:
+            value = (raw - raw_center) / max(raw_max - raw_center, 1.0e-6)
+        value = clamp(-1.0, value, 1.0)
+
+        if self.invert:
+            value = -value
+
+        if -self.dead_zone < value < self.dead_zone:
+            value = 0.0
+
+        value = (1.0 - self.expo) * value + self.expo * value ** 3
+
+        return clamp(-1.0, value + self.trim, 1.0)
+
+
+    def build_table(self):
+        return tuple(self.shape(raw) for raw in range(KPAxisShaping.raw_size))
+
+
+
+#--- Remote control input shaper
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Holds one lookup table per joystick axis, compiled from its KPAxisShaping
+# when configured; shaping a received value is a single indexed read. A new
+# table is built completely before it replaces the old one, so the shaping
+# can be changed from another thread while the flight controller is reading.
+class KPInputShaper():
+
+    axes = ('joystick_x', 'joystick_y', 'joystick_z')
+
+    # the original joystick mapping: y and z inverted
+    default_shaping = {
+        'joystick_x'    : KPAxisShaping(invert=False),
+        'joystick_y'    : KPAxisShaping(invert=True),
+        'joystick_z'    : KPAxisShaping(invert=True),
+    }
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, shaping=None):
+        self.shaping = dict(KPInputShaper.default_shaping)
+        self.tables = {}
+        for axis in KPInputShaper.axes:
+            self.configure(axis, self.shaping[axis])
+
+        if shaping is not None:
+            for (axis, axis_shaping) in shaping.items():
+                self.configure(axis, axis_shaping)
+
+
+    # M E T H O D S
+    #===========================================================================
+    def configure(self, axis, axis_shaping):
+        if axis not in KPInputShaper.axes:
+            raise ValueError('Unknown joystick axis: {}'.format(axis))
+
+        table = axis_shaping.build_table()
+        self.shaping[axis] = axis_shaping
+        self.tables[axis] = table
+
+
+    def shape(self, axis, raw):
+        return self.tables[axis][min(raw, KPAxisShaping.raw_size - 1)]
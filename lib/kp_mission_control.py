@@ -29,6 +29,7 @@ class KPMissionProgram(QtCore.QObject):
         self.description = description
         self.settings = settings
         self.state = 'disabled'
+        self.num = None
 
 
 
@@ -142,6 +143,9 @@ class KPMissionProgramsDatabase(QtCore.QObject):
             mp_horizontal_stabilize,
         ]
         
+        for (program_num, mp) in enumerate(self.db):
+            mp.num = program_num
+        
         self._current_program = self.db[0]
         
     
@@ -152,7 +156,7 @@ class KPMissionProgramsDatabase(QtCore.QObject):
             self._current_program = self.db[program_num]
             self.current_program_updated.emit(self._current_program)
             
-            self._log("Activated program {:2d}: {:s}".format(program_num, self._current_program.name))
+            self._log("Activated program {:2d}: {:s}", log_args=(program_num, self._current_program.name))
 
 
     def set_current_program_id(self, program_id):
@@ -179,8 +183,8 @@ class KPMissionProgramsDatabase(QtCore.QObject):
     
     # H E L P E R   F U N C T I O N S 
     #===========================================================================
-    def _log(self, log_message, log_type='info', log_data=None):
-        Logger.log(KPMissionProgramsDatabase.subsys, log_message, log_type, log_data)
+    def _log(self, log_message, log_type='info', log_data=None, log_args=None):
+        Logger.log(KPMissionProgramsDatabase.subsys, log_message, log_type, log_data, log_args)
     
     
 
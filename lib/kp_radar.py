@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import math, time
+
+import numpy as np
+
+from lib.kp_tools import clamp
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  F U N C T I O N S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+def scroll_grid(grid, dy, dx, fill_value):
+    # new grid whose cell [y][x] is grid[y + dy][x + dx], exposed cells filled
+    (s_y, s_x) = grid.shape
+    scrolled = np.full(grid.shape, fill_value, dtype=grid.dtype)
+
+    if abs(dy) < s_y and abs(dx) < s_x:
+        scrolled[max(0, -dy):s_y - max(0, dy), max(0, -dx):s_x - max(0, dx)] = \
+            grid[max(0, dy):s_y - max(0, -dy), max(0, dx):s_x - max(0, -dx)]
+
+    return scrolled
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Radar frame
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Immutable snapshot of a completed radar map. The heights array is a private
+# copy marked read-only, so frames can be handed to other threads while the
+# map keeps being written.
+class KPRadarFrame():
+
+    __slots__ = ('sequence', 'origin', 'cell_deg', 'heights', 'reference_height')
+
+    def __init__(self, sequence, origin, cell_deg, heights, reference_height):
+        self.sequence = sequence
+        self.origin = origin                        # geographic cell coordinates of heights[0][0]
+        self.cell_deg = cell_deg
+        self.heights = heights
+        self.reference_height = reference_height    # surface height under the vessel
+
+
+
+#--- Radar height map
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Square grid of surface heights around the vessel. Cells are anchored to
+# fixed geographic cell coordinates (latitude and longitude divided by the
+# angular cell size), so the terrain under a cell never changes. When the
+# vessel moves, the grid scrolls by whole cells: heights that are still in
+# view are kept, and only the newly exposed cells need sampling.
+#
+# Sampling modes:
+#   'uniform'  - every cell is sampled, in scan order
+#   'adaptive' - cells near the vessel and along its ground track are sampled
+#                at full resolution; further out, only every 2nd (then 4th)
+#                cell is sampled and its neighbours take the same height.
+#                Cells are sampled nearest-first, biased along the track.
+#
+# heights[y][x]: y is the latitude index, x is the longitude index.
+class KPRadarMap():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, resolution=30, element_spacing=0.5, sampling='uniform', fine_radius=6, track_width=2.0):
+        self.resolution = resolution
+        self.element_spacing = element_spacing      # meters
+        self.sampling = sampling
+        self.fine_radius = fine_radius              # cells
+        self.track_width = track_width              # cells either side of the ground track
+
+        self.heights = np.full((resolution, resolution), np.nan)
+        self.sampled = np.zeros((resolution, resolution), dtype=bool)
+        self.samples_taken = 0
+        self.sample_cost = 0.001                    # running estimate (seconds)
+
+        self._cell_deg = None
+        self._origin = None         # geographic cell coordinates of heights[0][0]
+        self._complete = False
+
+        # last published frame
+        self.frame = None
+        self._frame_sequence = 0
+
+        # cell offsets from the grid center
+        half = resolution // 2
+        (self._dy, self._dx) = np.mgrid[0:resolution, 0:resolution] - half
+        self._ring = np.maximum(np.abs(self._dy), np.abs(self._dx))
+
+
+    # M E T H O D S
+    #===========================================================================
+    def set_body(self, body_radius):
+        # angular size of a cell on this body; clears the map
+        self._cell_deg = math.degrees(self.element_spacing / body_radius)
+        self.reset()
+
+
+    def reset(self):
+        self.heights.fill(np.nan)
+        self.sampled.fill(False)
+        self._origin = None
+        self._complete = False
+        self.frame = None
+
+
+    def is_complete(self):
+        return self._complete
+
+
+    def cell_center(self, y_idx, x_idx):
+        # latitude and longitude of the center of a grid cell
+        latitude = (self._origin[0] + y_idx + 0.5) * self._cell_deg
+        longitude = (self._origin[1] + x_idx + 0.5) * self._cell_deg
+        return (clamp(-89.9, latitude, 89.9), longitude)
+
+
+    def update(self, latitude, longitude, sampler, max_samples=None, time_budget=None, velocity=(0.0, 0.0)):
+        # Re-centers the map on the vessel and samples missing cells with
+        # sampler(latitude, longitude). The number of samples is limited by
+        # max_samples and/or by time_budget (seconds), using the running
+        # estimate of the cost of one sample. velocity is the (north, east)
+        # horizontal speed, used to find the ground track.
+        #
+        # Returns True if this call completed the map.
+        if self._cell_deg is None:
+            return False
+
+        half = self.resolution // 2
+        origin = (
+            int(math.floor(latitude / self._cell_deg)) - half,
+            int(math.floor(longitude / self._cell_deg)) - half)
+
+        if origin != self._origin:
+            self._scroll(origin)
+
+        # cells that need a sample, in sampling order
+        if self.sampling == 'adaptive':
+            (required, stride, priority) = self._adaptive_plan(velocity)
+        else:
+            required = np.ones(self.heights.shape, dtype=bool)
+            stride = None
+            priority = None
+
+        needed = np.flatnonzero(required & ~self.sampled)
+        if priority is not None and len(needed) > 0:
+            needed = needed[np.argsort(priority.ravel()[needed], kind='stable')]
+
+        # how many samples fit in this call
+        num_samples = len(needed)
+        if max_samples is not None:
+            num_samples = min(num_samples, max_samples)
+        if time_budget is not None:
+            # at least one, so that the cost estimate recovers after a slow
+            # sample
+            num_samples = min(num_samples, max(1, int(time_budget / self.sample_cost)))
+
+        if num_samples > 0:
+            start_time = time.perf_counter()
+            deadline = (start_time + time_budget) if time_budget is not None else None
+
+            samples = 0
+            for cell in needed[:num_samples]:
+                (y_idx, x_idx) = divmod(int(cell), self.resolution)
+                (cell_latitude, cell_longitude) = self.cell_center(y_idx, x_idx)
+                self.heights[y_idx, x_idx] = sampler(cell_latitude, cell_longitude)
+                self.sampled[y_idx, x_idx] = True
+                samples += 1
+
+                # the cost estimate can be off when cache hits turn to misses
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+
+            # a single stall counts for no more than the whole budget
+            cost = (time.perf_counter() - start_time) / samples
+            if time_budget is not None:
+                cost = min(cost, max(time_budget, 1.0e-6))
+            self.sample_cost = 0.8 * self.sample_cost + 0.2 * max(cost, 1.0e-6)
+            self.samples_taken += samples
+            num_samples = samples
+
+        # spread coarse samples over the cells they stand for
+        if stride is not None:
+            self._fill_coarse_cells(required, stride)
+
+        was_complete = self._complete
+        self._complete = (num_samples == len(needed))
+
+        return self._complete and not was_complete
+
+
+    def publish(self, reference_height):
+        # snapshots the map as an immutable frame, and returns it
+        heights = self.heights.copy()
+        heights.setflags(write=False)
+
+        self._frame_sequence += 1
+        self.frame = KPRadarFrame(self._frame_sequence, self._origin, self._cell_deg, heights, reference_height)
+        return self.frame
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _adaptive_plan(self, velocity):
+        # sampling stride per cell: 1 near the vessel, 2 in the middle ring,
+        # 4 at the periphery, and 1 along the ground track
+        stride = np.where(self._ring <= self.fine_radius, 1,
+            np.where(self._ring <= 2 * self.fine_radius, 2, 4))
+
+        (v_north, v_east) = velocity
+        speed = math.sqrt(v_north ** 2 + v_east ** 2)
+        along_track = np.zeros(self.heights.shape)
+
+        if speed > 0.1:
+            along_track = (self._dy * v_north + self._dx * v_east) / speed
+            cross_track = np.abs(self._dy * v_east - self._dx * v_north) / speed
+            stride = np.where((along_track > 0.0) & (cross_track <= self.track_width), 1, stride)
+
+        # sample on a lattice anchored to geographic cells, so coarse samples
+        # stay valid as the grid scrolls
+        lat_cells = self._origin[0] + self._dy + self.resolution // 2
+        lon_cells = self._origin[1] + self._dx + self.resolution // 2
+        required = ((lat_cells % stride) == 0) & ((lon_cells % stride) == 0)
+
+        priority = self._ring - 0.5 * np.clip(along_track, 0.0, None)
+
+        return (required, stride, priority)
+
+
+    def _fill_coarse_cells(self, required, stride):
+        # cells off the lattice take the height of their lattice cell
+        fill = ~required & ~self.sampled
+        if not fill.any():
+            return
+
+        (y_idx, x_idx) = np.nonzero(fill)
+        cell_stride = stride[y_idx, x_idx]
+        anchor_y = y_idx - (self._origin[0] + y_idx) % cell_stride
+        anchor_x = x_idx - (self._origin[1] + x_idx) % cell_stride
+
+        # at the low edges of the grid, use the next lattice cell instead
+        anchor_y = np.where(anchor_y < 0, anchor_y + cell_stride, anchor_y)
+        anchor_x = np.where(anchor_x < 0, anchor_x + cell_stride, anchor_x)
+
+        inside = (anchor_y < self.resolution) & (anchor_x < self.resolution)
+        anchor_y = np.clip(anchor_y, 0, self.resolution - 1)
+        anchor_x = np.clip(anchor_x, 0, self.resolution - 1)
+        anchor_known = self.sampled[anchor_y, anchor_x] & inside
+
+        self.heights[y_idx, x_idx] = np.where(anchor_known, self.heights[anchor_y, anchor_x], np.nan)
+
+
+    def _scroll(self, origin):
+        if self._origin is None:
+            self.heights.fill(np.nan)
+            self.sampled.fill(False)
+            self._origin = origin
+            return
+
+        dy = origin[0] - self._origin[0]
+        dx = origin[1] - self._origin[1]
+        self._origin = origin
+        self._complete = False
+
+        # keep the overlapping region, expose the rest
+        self.heights = scroll_grid(self.heights, dy, dx, np.nan)
+        self.sampled = scroll_grid(self.sampled, dy, dx, False)
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import time
+
+from lib.kp_tools import StateVariable
+from lib.logger import Logger
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Scheduled task
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+class KPScheduledTask():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, name, callback, budget, critical=False):
+        self.name = name
+        self.callback = callback
+        self.budget = budget            # allowed cost per tick, averaged over throttled ticks (seconds)
+        self.critical = critical        # critical tasks are never throttled
+
+        # throttling: the task runs once every 'throttle' ticks
+        self.throttle = 1
+        self._ticks_skipped = 0
+
+        # end of the current run's budget, set by the scheduler
+        self.deadline = 0.0
+
+        # accounting; the cost average starts at the first measured cost
+        self.cost = StateVariable(register_size=10)
+        self.last_cost = 0.0
+        self.violations = 0
+        self._over_budget_runs = 0
+        self._under_budget_runs = 0
+
+
+    # M E T H O D S
+    #===========================================================================
+    def time_remaining(self):
+        # time left in the current run, within both the task's budget and the
+        # scheduler's period
+        return max(0.0, self.deadline - time.perf_counter())
+
+    def is_due(self):
+        self._ticks_skipped += 1
+        if self._ticks_skipped >= self.throttle:
+            self._ticks_skipped = 0
+            return True
+        return False
+
+
+
+#--- Task scheduler with per-task time budgets
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Runs a list of tasks every tick and measures what each one costs. A task
+# whose average cost per tick (its cost per run divided by its throttle)
+# exceeds its budget for several runs in a row is throttled (run every 2, 4,
+# 8 ... ticks); once it is at the throttle limit it is demoted to a slower
+# scheduler, if one was given. Tasks that come back well under
+# budget are un-throttled again. Critical tasks are only reported.
+class KPTaskScheduler():
+
+    violation_runs = 5          # consecutive over-budget runs before acting
+    recovery_runs = 20          # consecutive runs under half budget to recover
+    max_throttle = 8
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, name, period, subsys, demote_to=None):
+        self.name = name
+        self.period = period
+        self.subsys = subsys
+        self.demote_to = demote_to
+
+        self.tasks = []
+        self.timing = StateVariable(0.0, int(1.0 / period + 0.5))
+        self._tick_start_time = time.perf_counter()
+
+
+    # M E T H O D S
+    #===========================================================================
+    def add_task(self, name, callback, budget, critical=False):
+        task = KPScheduledTask(name, callback, budget, critical)
+        self.tasks.append(task)
+        return task
+
+
+    def remove_task(self, name):
+        task = self.get_task(name)
+        if task is not None:
+            self.tasks.remove(task)
+        return task
+
+
+    def get_task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+
+    def time_remaining(self):
+        # time left in the current tick before the scheduler overruns
+        return self.period - (time.perf_counter() - self._tick_start_time)
+
+
+    def run(self):
+        self._tick_start_time = time.perf_counter()
+
+        for task in list(self.tasks):
+            if not task.is_due():
+                continue
+
+            start_time = time.perf_counter()
+            task.deadline = min(start_time + task.budget, self._tick_start_time + self.period)
+            task.callback()
+            task.last_cost = time.perf_counter() - start_time
+            task.cost.update(task.last_cost)
+
+            self._check_budget(task)
+
+        # report scheduler overruns, naming the most expensive task
+        process_time = time.perf_counter() - self._tick_start_time
+        self.timing.update(process_time)
+
+        if process_time > self.period:
+            if Logger.is_enabled('warning'):
+                slowest_task = max(self.tasks, key=lambda t: t.last_cost) if len(self.tasks) > 0 else None
+                self._log_warning('{:s} overrun: {:.1f} ms, overrun by {:.1f} ms (slowest task "{:s}": {:.1f} ms)', log_args=(
+                    self.name,
+                    process_time * 1000.0,
+                    (process_time - self.period) * 1000.0,
+                    slowest_task.name if slowest_task is not None else '',
+                    slowest_task.last_cost * 1000.0 if slowest_task is not None else 0.0))
+
+
+    def task_timings(self):
+        return {task.name : task.cost.get_mean() for task in self.tasks if task.cost.length() > 0}
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _check_budget(self, task):
+        # a throttled task's cost is spread over the ticks it skips
+        mean_cost = task.cost.get_mean() / task.throttle
+
+        if mean_cost > task.budget:
+            task._over_budget_runs += 1
+            task._under_budget_runs = 0
+        elif mean_cost < task.budget * 0.5:
+            task._under_budget_runs += 1
+            task._over_budget_runs = 0
+        else:
+            task._over_budget_runs = 0
+            task._under_budget_runs = 0
+
+        # over budget for too long
+        if task._over_budget_runs >= KPTaskScheduler.violation_runs:
+            task._over_budget_runs = 0
+            task.violations += 1
+
+            if task.critical:
+                action = 'critical task, not throttled'
+            elif task.throttle < KPTaskScheduler.max_throttle:
+                task.throttle *= 2
+                action = 'throttled to every {:d} ticks'.format(task.throttle)
+            elif self.demote_to is not None:
+                self.tasks.remove(task)
+                task.throttle = 1
+                task.cost = StateVariable(register_size=10)
+                self.demote_to.tasks.append(task)
+                action = 'demoted to {:s}'.format(self.demote_to.name)
+            else:
+                action = 'already at maximum throttle'
+
+            self._log_warning('{:s} task "{:s}" over budget: {:.1f} ms per tick (budget {:.1f} ms), {:s}'.format(
+                self.name, task.name, mean_cost * 1000.0, task.budget * 1000.0, action))
+
+        # recovered
+        elif task._under_budget_runs >= KPTaskScheduler.recovery_runs and task.throttle > 1:
+            task._under_budget_runs = 0
+            task.throttle //= 2
+            self._log('{:s} task "{:s}" back under budget, running every {:d} ticks'.format(
+                self.name, task.name, task.throttle))
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _log(self, log_message, log_type='info', log_data=None, log_args=None):
+        Logger.log(self.subsys, log_message, log_type, log_data, log_args)
+
+    def _log_warning(self, log_message, log_data=None, log_args=None):
+        Logger.log_warning(self.subsys, log_message, log_data, log_args)
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import argparse, bisect, struct, time
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import QCoreApplication, QTimer, pyqtSignal, pyqtSlot
+
+from lib.kp_input_shaping import KPInputShaper
+from lib.kp_tools import LatestValue
+from lib.logger import Logger
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  F U N C T I O N S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+# Capture file format:
+#
+#   'KPCAP1\n' <comma-separated device names> '\n'
+#   records: <timestamp: float64> <device index: uint8> <size: uint32> <data>
+#
+# Timestamps are monotonic seconds since the start of the capture; each
+# record is one chunk of bytes as it was read from a device.
+capture_magic = b'KPCAP1\n'
+capture_record = struct.Struct('<dBI')
+
+
+def read_serial_capture(filename):
+    # returns the device names and a list of (timestamp, device index, data)
+    with open(filename, 'rb') as f:
+        if f.readline() != capture_magic:
+            raise ValueError('Not a serial capture file: {}'.format(filename))
+        device_names = f.readline().decode('ascii').strip().split(',')
+        contents = f.read()
+
+    records = []
+    offset = 0
+    while offset + capture_record.size <= len(contents):
+        (timestamp, device_index, size) = capture_record.unpack_from(contents, offset)
+        offset += capture_record.size
+        records.append((timestamp, device_index, contents[offset:offset + size]))
+        offset += size
+
+    return (device_names, records)
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Serial capture writer
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Records received byte chunks. Writes go through the file's buffer, so
+# recording costs a struct pack and a memory copy per chunk.
+class KPSerialCaptureWriter():
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, filename, device_names):
+        self.filename = filename
+        self.chunks = 0
+        self.bytes = 0
+
+        self._device_index = {name : index for (index, name) in enumerate(device_names)}
+        self._start_time = time.perf_counter()
+
+        self._file = open(filename, 'wb')
+        self._file.write(capture_magic)
+        self._file.write(','.join(device_names).encode('ascii') + b'\n')
+
+
+    # M E T H O D S
+    #===========================================================================
+    def write(self, device_name, timestamp, data):
+        # timestamp from time.perf_counter()
+        self._file.write(capture_record.pack(timestamp - self._start_time, self._device_index[device_name], len(data)))
+        self._file.write(data)
+        self.chunks += 1
+        self.bytes += len(data)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+
+#--- Serial capture replay
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Feeds a capture back through KPSerialInterface.receive(), to the devices
+# with the same names. At 'speed' > 0 the chunks are replayed on a timer at
+# that multiple of their original timing, from the thread the replay lives
+# in; at speed 0 run() replays them all at once, as fast as possible.
+class KPSerialReplay(QtCore.QObject):
+
+    subsys = 'SERIAL_REPLAY'
+
+
+    # S I G N A L S
+    #===========================================================================
+    finished = pyqtSignal()
+
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, serial_iface, filename, speed=1.0, **kwds):
+        super(KPSerialReplay, self).__init__(**kwds)
+
+        self.filename = filename
+        self.speed = speed
+        self.chunks_replayed = 0
+        self.chunks_skipped = 0
+
+        (device_names, self._records) = read_serial_capture(filename)
+        self._timestamps = [record[0] for record in self._records]
+        self._next_record = 0
+        self._start_time = None
+
+        # devices of the interface, by capture device index
+        devices = {device.name : device for device in serial_iface.devices}
+        self._devices = [devices.get(name) for name in device_names]
+        self._serial_iface = serial_iface
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._replay_due)
+
+
+    # M E T H O D S
+    #===========================================================================
+    def start(self):
+        self._log('Replaying {:s}: {:d} chunks, {:.1f} s'.format(
+            self.filename, len(self._records), self._timestamps[-1] if len(self._records) > 0 else 0.0))
+
+        self._next_record = 0
+        if self.speed <= 0.0:
+            self.run()
+        else:
+            self._start_time = time.perf_counter()
+            self._replay_due()
+
+
+    def stop(self):
+        self._timer.stop()
+
+
+    def run(self):
+        # every remaining chunk, without waiting
+        self._feed(len(self._records))
+        self.finished.emit()
+
+
+    def is_running(self):
+        return self._timer.isActive()
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _feed(self, end_record):
+        for (timestamp, device_index, data) in self._records[self._next_record:end_record]:
+            device = self._devices[device_index]
+            if device is None:
+                self.chunks_skipped += 1
+                continue
+            self._serial_iface.receive(device, data)
+            self.chunks_replayed += 1
+        self._next_record = end_record
+
+
+    @pyqtSlot()
+    def _replay_due(self):
+        # every chunk that is due, then wait for the next one
+        capture_time = (time.perf_counter() - self._start_time) * self.speed
+        self._feed(bisect.bisect_right(self._timestamps, capture_time, lo=self._next_record))
+
+        if self._next_record >= len(self._records):
+            self._log('Replay finished ({:d} chunks, {:d} skipped)'.format(self.chunks_replayed, self.chunks_skipped))
+            self.finished.emit()
+            return
+
+        wait_time = (self._timestamps[self._next_record] - capture_time) / self.speed
+        self._timer.start(max(0, int(wait_time * 1000.0)))
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _log(self, log_message, log_type='info', log_data=None):
+        Logger.log(KPSerialReplay.subsys, log_message, log_type, log_data)
+
+
+
+#--- Remote control path profiler
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Stands in for KPSerialInterface.rc_state during a replay: shapes every
+# published state the way the flight controller does, and times it.
+class KPShapingRecorder(LatestValue):
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, shaper=None):
+        super(KPShapingRecorder, self).__init__()
+        self.shaper = shaper if shaper is not None else KPInputShaper()
+        self.states = 0
+        self.shaping_time = 0.0
+
+
+    # M E T H O D S
+    #===========================================================================
+    def put(self, value):
+        super(KPShapingRecorder, self).put(value)
+        start_time = time.perf_counter()
+        for axis in KPInputShaper.axes:
+            self.shaper.shape(axis, getattr(value, axis))
+        self.shaping_time += time.perf_counter() - start_time
+        self.states += 1
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#  E N T R Y   P O I N T   =#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+if __name__ == '__main__':
+
+    # imported here: kp_serial_interface imports this module
+    from lib.kp_serial_interface import KPSerialDevice, KPSerialInterface
+
+    # parse command-line arguments
+    #===========================================================================
+    arg_parser = argparse.ArgumentParser(description="Replay a serial capture through the frame parser")
+    arg_parser.add_argument("capture_file",
+        help="Capture file recorded by KPSerialInterface")
+    arg_parser.add_argument("-s", "--speed",
+        help="Replay speed relative to the capture, 0 for as fast as possible",
+        type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    app = QCoreApplication([])
+
+    (device_names, records) = read_serial_capture(args.capture_file)
+    serial_iface = KPSerialInterface(devices=[KPSerialDevice(name, None) for name in device_names])
+    recorder = KPShapingRecorder()
+    serial_iface.rc_state = recorder
+
+    replay = KPSerialReplay(serial_iface, args.capture_file, speed=args.speed)
+    replay.finished.connect(app.quit)
+
+    start_time = time.perf_counter()
+    replay.start()
+    if replay.is_running():
+        app.exec_()
+    elapsed_time = time.perf_counter() - start_time
+
+    link_stats = serial_iface.stats()
+    frames = link_stats['frames']
+    print('Chunks replayed:   {:d} ({:d} bytes, {:d} skipped) in {:.3f} s'.format(
+        replay.chunks_replayed, sum(len(record[2]) for record in records), replay.chunks_skipped, elapsed_time))
+    print('Frames:            {:d} ({:d} unknown)'.format(frames, link_stats['unknown_frames']))
+    print('Resyncs:           {:d} ({:d} bytes dropped)'.format(link_stats['resyncs'], link_stats['bytes_dropped']))
+    print('Receive CPU:       {:.1f} us/frame'.format(link_stats['rx_process_time'] / max(1, frames) * 1.0e6))
+    print('Shaping CPU:       {:.1f} us/state'.format(recorder.shaping_time / max(1, recorder.states) * 1.0e6))
@@ -1,4 +1,4 @@
-import collections, krpc, math, struct, time
+import collections, math, struct, time
 
 from time import sleep
 
@@ -7,6 +7,7 @@ from PyQt5.QtCore import QCoreApplication, QIODevice, Qt, QTimer, QVariant
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from PyQt5.QtSerialPort import QSerialPort
 
+from lib.kp_serial_capture import KPSerialCaptureWriter, KPSerialReplay
 from lib.kp_tools import *
 from lib.logger import Logger
 
@@ -15,13 +16,221 @@ from lib.logger import Logger
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 
-    
+#--- Serial frame parser
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Splits the serial byte stream into frames:
+#
+#   '$' '$' <size> <message type> <message data ...>
+#
+# where size counts the message type and data bytes. The same framing is
+# used for the telemetry downlink to the controller. Received data is
+# appended to a single bytearray; frames are located with find() and
+# decoded in place with precompiled structs, and the consumed bytes are
+# removed once per parse. Every complete frame in the buffer is parsed in
+# one pass. Bytes that are not part of a frame are discarded and counted.
+# Frame sizes of 0 and 36 ('$') are not valid.
+class KPSerialFramer():
+
+    header = b'$$'
+    msg_type_state = 0x40
+    msg_type_telemetry = 0x41
+
+    # state message (uplink): type, button states, joystick x, y, z
+    state_message = struct.Struct('<BBHHH')
+
+    # telemetry message (downlink): type, mean altitude, surface altitude,
+    # vertical speed, vertical speed setpoint, throttle (0-255), program number
+    telemetry_message = struct.Struct('<BffffBB')
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self):
+        self._buffer = bytearray()
+
+        # statistics
+        self.frames = 0
+        self.unknown_frames = 0
+        self.resyncs = 0
+        self.bytes_dropped = 0
+
+
+    # M E T H O D S
+    #===========================================================================
+    def append(self, data):
+        self._buffer += data
+
+
+    def feed(self, data):
+        self._buffer += data
+        return self.parse()
+
+
+    def parse(self):
+        # Returns the decoded messages of every complete frame in the buffer,
+        # as a list of (message type, values) tuples. Incomplete frames stay
+        # in the buffer until more data arrives.
+        buffer = self._buffer
+        size = len(buffer)
+        position = 0
+        messages = []
+
+        while True:
+            start = buffer.find(KPSerialFramer.header, position)
+
+            if start < 0:
+                # no header: keep a trailing '$', it may start the next one
+                keep = size - 1 if size > position and buffer[size - 1] == 0x24 else size
+                self._drop(keep - position)
+                position = keep
+                break
+
+            self._drop(start - position)
+            position = start
+
+            if start + 3 > size:
+                break
+
+            # an empty frame, or a third '$', is line noise before the
+            # header: skip one byte
+            msg_size = buffer[start + 2]
+            if msg_size == 0 or msg_size == 0x24:
+                self._drop(1)
+                position = start + 1
+                continue
+
+            end = start + 3 + msg_size
+            if end > size:
+                break
+
+            # known message types must have their exact size
+            msg_type = buffer[start + 3]
+            if msg_type == KPSerialFramer.msg_type_state:
+                if msg_size != KPSerialFramer.state_message.size:
+                    self._drop(1)
+                    position = start + 1
+                    continue
+                messages.append((msg_type, KPSerialFramer.state_message.unpack_from(buffer, start + 3)[1:]))
+            else:
+                self.unknown_frames += 1
+
+            self.frames += 1
+            position = end
+
+        del buffer[:position]
+        return messages
+
+
+    def pending(self):
+        # bytes waiting for the rest of their frame
+        return len(self._buffer)
+
+
+    def clear(self):
+        self._buffer.clear()
+
+
+    def stats(self):
+        return {
+            'frames'            : self.frames,
+            'unknown_frames'    : self.unknown_frames,
+            'resyncs'           : self.resyncs,
+            'bytes_dropped'     : self.bytes_dropped,
+        }
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _drop(self, num_bytes):
+        if num_bytes > 0:
+            self.resyncs += 1
+            self.bytes_dropped += num_bytes
+
+
+
+#--- Serial input device
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# One serial port and its framer. A device provides some of the remote
+# control inputs ('controls'); when several devices provide the same input,
+# the one with the highest priority that has sent a state recently wins. If
+# none has, joystick axes return to neutral, but buttons and switches keep
+# the last state received.
+class KPSerialDevice():
+
+    controls_all = ('buttons', 'joystick_x', 'joystick_y', 'joystick_z')
+    rate_window = 1.0
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, name, port, baudrate=250000, priority=0, controls=controls_all, downlink=True):
+        self.name = name
+        self.port = port
+        self.baudrate = baudrate
+        self.priority = priority
+        self.controls = tuple(controls)
+        self.downlink = downlink            # send the telemetry downlink to this device
+
+        self.serial = None
+        self.framer = KPSerialFramer()
+
+        # latest state received from this device
+        self.state = None
+        self.state_time = 0.0
+        self.stale = False                  # no state for stale_timeout
+
+        # time from readyRead to the published remote control state (seconds)
+        self.rx_latency = StateVariable(0.0, 100)
+        self.rx_latency_max = 0.0
+        self.rx_process_time = 0.0
+
+        # received frames per second, measured over rate_window seconds
+        self._rate_time = time.perf_counter()
+        self._rate_frames = 0
+        self.frame_rate = 0.0
+
+
+    # M E T H O D S
+    #===========================================================================
+    def is_open(self):
+        return self.serial is not None and self.serial.isOpen()
+
+
+    def update_frame_rate(self, now):
+        if now - self._rate_time >= KPSerialDevice.rate_window:
+            self.frame_rate = (self.framer.frames - self._rate_frames) / (now - self._rate_time)
+            self._rate_time = now
+            self._rate_frames = self.framer.frames
+
+
+    def stats(self):
+        device_stats = self.framer.stats()
+        device_stats['frame_rate'] = self.frame_rate
+        device_stats['rx_latency_mean'] = self.rx_latency.get_mean()
+        device_stats['rx_latency_max'] = self.rx_latency_max
+        device_stats['rx_process_time'] = self.rx_process_time
+        return device_stats
+
+
+
 #--- Serial port interface
 #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Manages every serial input device from one thread. Each device has its own
+# framer; every received state is merged with the latest states of the other
+# devices, control by control, into a single KPRemoteControlState that is
+# published in rc_state.
 class KPSerialInterface(QtCore.QObject):
 
     subsys = 'SERIAL'
-    msg_parser_period = 0.005
+    downlink_link_share = 0.25      # largest share of the link used by the downlink
+    stale_timeout = 0.5             # seconds without a state before a device is ignored
+
+    # neutral values of axes no device is providing; buttons and switches
+    # are held instead, so that a short dropout of the device providing them
+    # does not switch off the engines or the autopilot
+    neutral_controls = {
+        'joystick_x'    : 512,
+        'joystick_y'    : 512,
+        'joystick_z'    : 512,
+    }
 
         
     # S I G N A L S 
@@ -29,12 +238,11 @@ class KPSerialInterface(QtCore.QObject):
     connected = pyqtSignal()
     disconnected = pyqtSignal()
     finished = pyqtSignal()
-    rc_command = pyqtSignal(KPRemoteControlState)
 
     
     # C O N S T R U C T O R 
     #===========================================================================
-    def __init__(self, serial_port="COM4", serial_baudrate=250000, **kwds):
+    def __init__(self, serial_port="COM4", serial_baudrate=250000, downlink_rate=10.0, devices=None, capture_file=None, replay_file=None, **kwds):
         super(KPSerialInterface, self).__init__(**kwds)
         
         # thread variables
@@ -42,77 +250,184 @@ class KPSerialInterface(QtCore.QObject):
         self._current_time = time.time()
         self._previous_time = self._current_time
         
-        # serial interface
-        self._serial = None
+        # serial devices; a single device on serial_port unless a list is given
         self.is_connected = False
-        self.port = serial_port
-        self.baudrate = serial_baudrate
-        self._rx_buffer = collections.deque(maxlen=512)
-
-        # initialize control timers
-        self._message_parser_timer = QTimer()
+        if devices is None:
+            devices = [KPSerialDevice('controller', serial_port, serial_baudrate)]
+        self.devices = devices
+
+        # devices providing each control, highest priority first
+        self._control_sources = {}
+        for control in KPSerialDevice.controls_all:
+            sources = [device for device in self.devices if control in device.controls]
+            self._control_sources[control] = sorted(sources, key=lambda device: -device.priority)
+
+        # latest remote control state, read by the flight controller; the
+        # stale timer republishes it when devices stop sending, so that axes
+        # return to neutral without waiting for another frame
+        self.rc_state = LatestValue()
+        self._stale_timer = QTimer(self)
+        self._stale_timer.timeout.connect(self._check_stale)
+
+        # presses of each button in the published states
+        self._published_buttons = 0
+        self._button_presses = (0,) * KPRemoteControlState.button_count
+
+        # received bytes are recorded to capture_file while connected; with
+        # a replay_file, connecting replays it instead of opening the ports
+        self.capture_file = capture_file
+        self.replay_file = replay_file
+        self._capture = None
+        self._replay = None
+
+        # telemetry downlink: the flight controller puts a tuple of telemetry
+        # message values in the slot, the downlink timer sends the newest
+        self.downlink = LatestValue()
+        self.downlink_rate = downlink_rate          # frames per second, 0 to disable
+        self._downlink_sequence = 0
+        self._downlink_timer = QTimer(self)
+        self._downlink_timer.timeout.connect(self.send_downlink)
+        self._downlink_frame = bytearray(KPSerialFramer.header)
+        self._downlink_frame.append(KPSerialFramer.telemetry_message.size)
+        self._downlink_frame += bytes(KPSerialFramer.telemetry_message.size)
+        self.downlink_frames = 0
+        self.downlink_skipped = 0
         
-        self._message_parser_timer.timeout.connect(self.parse_rx_buffer)
-        self._message_parser_timer.start(KPSerialInterface.msg_parser_period * 1000.0)
 
-        # data variables
-        self._rc_cmd = KPRemoteControlState()
-        
+    # G E T T E R S   /   S E T T E R S 
+    #===========================================================================
+    # the port settings in the GUI apply to the first device
+    @property
+    def port(self):
+        return self.devices[0].port
+
+    @port.setter
+    def port(self, port):
+        self.devices[0].port = port
+
+    @property
+    def baudrate(self):
+        return self.devices[0].baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.devices[0].baudrate = baudrate
 
         
     # M E T H O D S 
     #===========================================================================
-    def connect(self):
-        if self._serial is None:
-            self._serial = QSerialPort()
-            self._serial.readyRead.connect(self.serial_read_bytes)
-
-        self._serial.setPortName(self.serial_port)
-        self._serial.setBaudRate(self.serial_baudrate)
-
-        try:
-            # attempt to connect
-            self._log('Connecting serial port {:s} ...'.format(self.serial_port))
-            self._serial.open(QIODevice.ReadWrite)
-            
-            # emit succesful connection signals
-            self.serial_is_connected = True
-            self.serial_connected.emit()
-            
-            self._log('Connected serial port!')
-            
-        except Exception as e:
-            self._log_exception('Unable to open serial port', e)
+    def stats(self):
+        # totals over all devices, and each device's statistics
+        device_stats = {device.name : device.stats() for device in self.devices}
+
+        link_stats = {}
+        for key in ('frames', 'unknown_frames', 'resyncs', 'bytes_dropped', 'frame_rate', 'rx_process_time'):
+            link_stats[key] = sum(stats[key] for stats in device_stats.values())
+        link_stats['rx_latency_max'] = max(stats['rx_latency_max'] for stats in device_stats.values())
+        link_stats['downlink_frames'] = self.downlink_frames
+        link_stats['downlink_skipped'] = self.downlink_skipped
+        link_stats['devices'] = device_stats
+        return link_stats
     
     
     # P R I V A T E   M E T H O D S 
     #===========================================================================
-    def _parse_message(self, message):
-        msg_bytes = ''
-        for b in message:
-            msg_bytes += hex(b) + " "
+    def _start_downlink(self):
+        if self.downlink_rate <= 0.0:
+            return
 
-        #print("Message received! {:s}".format(msg_bytes))
+        # limit the rate to a share of the slowest link (10 bits per byte)
+        baudrates = [device.baudrate for device in self.devices if device.downlink and device.is_open()]
+        if len(baudrates) == 0:
+            return
+        frame_bits = len(self._downlink_frame) * 10.0
+        max_rate = KPSerialInterface.downlink_link_share * min(baudrates) / frame_bits
+        rate = min(self.downlink_rate, max_rate)
 
-        message_type = message[0]
+        self._downlink_timer.start(int(1000.0 / rate))
+        self._log('Telemetry downlink at {:.1f} frames/s'.format(rate))
 
-        if message_type == 0x40:
-            button_state = message[1]
-            message_bytes = bytearray(message)
-            joystick_x = struct.unpack("H", message_bytes[2:4])[0]
-            joystick_y = struct.unpack("H", message_bytes[4:6])[0]
-            joystick_z = struct.unpack("H", message_bytes[6:8])[0]
 
-            #print("State message: {:4s} {:4d} {:4d} {:4d}".format(hex(button_state), joystick_x, joystick_y, joystick_z))
+    def _connect_replay(self):
+        if self._replay is not None:
+            return
+
+        try:
+            self._replay = KPSerialReplay(self, self.replay_file, parent=self)
+        except (IOError, ValueError) as e:
+            self._log_exception('Unable to open serial capture', e)
+            return
+
+        self.is_connected = True
+        self.connected.emit()
+        self._stale_timer.start(int(KPSerialInterface.stale_timeout * 500.0))
+        self._replay.start()
+
+
+    def _handle_message(self, device, message_type, values):
+        if message_type == KPSerialFramer.msg_type_state:
+            device.state = KPRemoteControlState(*values)
+            device.state_time = time.perf_counter()
+            if device.stale:
+                device.stale = False
+                self._log('Serial device "{:s}" is sending again'.format(device.name))
+
+            # newer states overwrite older ones the flight controller has not
+            # read yet
+            if len(self.devices) == 1:
+                self._publish(*values)
+            else:
+                self._publish(*self._merge_states(device.state_time))
+
+
+    def _publish(self, button_state, joystick_x, joystick_y, joystick_z):
+        # counts button presses, so that a press and release between two
+        # reads of rc_state still reaches the flight controller
+        pressed = button_state & ~self._published_buttons
+        self._published_buttons = button_state
+        if pressed != 0:
+            self._button_presses = tuple(count + ((pressed >> bit) & 1) for (bit, count) in enumerate(self._button_presses))
+
+        self.rc_state.put(KPRemoteControlState(button_state, joystick_x, joystick_y, joystick_z, self._button_presses))
+
+
+    def _merge_states(self, now):
+        # each control from the highest priority device with a recent state,
+        # as (buttons, joystick_x, joystick_y, joystick_z)
+        values = dict(KPSerialInterface.neutral_controls)
+
+        for (control, sources) in self._control_sources.items():
+            held = None
+            for device in sources:
+                if device.state is None:
+                    continue
+                value = device.state.button_state if control == 'buttons' else getattr(device.state, control)
+                if (now - device.state_time) <= KPSerialInterface.stale_timeout:
+                    values[control] = value
+                    break
+                if held is None:
+                    held = value
+            else:
+                # no recent state: hold the last one, except for axes
+                if control not in KPSerialInterface.neutral_controls:
+                    values[control] = held if held is not None else 0
+
+        return (values['buttons'], values['joystick_x'], values['joystick_y'], values['joystick_z'])
 
-            # construct remote control command object
-            #rc_cmd = KPRemoteControlState(button_state, joystick_x, joystick_y, joystick_z)
-            self._rc_cmd.set_button_states(button_state)
-            self._rc_cmd.joystick['x'] = joystick_x
-            self._rc_cmd.joystick['y'] = joystick_y
-            self._rc_cmd.joystick['z'] = joystick_z
 
-            self.rc_command.emit(self._rc_cmd)
+    @pyqtSlot()
+    def _check_stale(self):
+        # republish the merged state when a device has stopped sending
+        now = time.perf_counter()
+        stale_devices = [device for device in self.devices
+            if device.state is not None and not device.stale and (now - device.state_time) > KPSerialInterface.stale_timeout]
+        if len(stale_devices) == 0:
+            return
+
+        for device in stale_devices:
+            device.stale = True
+            self._log_warning('Serial device "{:s}" stopped sending, centering its axes'.format(device.name))
+        self._publish(*self._merge_states(now))
         
     
     # S L O T S 
@@ -134,95 +449,141 @@ class KPSerialInterface(QtCore.QObject):
 
     @pyqtSlot()
     def connect(self):
-        if self._serial is None:
-            self._serial = QSerialPort()
-            self._serial.readyRead.connect(self.read_data)
-
-        self._serial.setPortName(self.port)
-        self._serial.setBaudRate(self.baudrate)
-
-        try:
-            # attempt to connect
-            self._log('Connecting serial port {:s} ...'.format(self.port))
-            self._serial.open(QIODevice.ReadWrite)
-            
-            # emit succesful connection signals
+        if self.replay_file:
+            self._connect_replay()
+            return
+
+        for device in self.devices:
+            if device.is_open():
+                continue
+
+            if device.serial is None:
+                device.serial = QSerialPort()
+                device.serial.readyRead.connect(lambda device=device: self.read_data(device))
+
+            device.serial.setPortName(device.port)
+            device.serial.setBaudRate(device.baudrate)
+
+            try:
+                # attempt to connect
+                self._log('Connecting serial device "{:s}" on {:s} ...'.format(device.name, device.port))
+                if device.serial.open(QIODevice.ReadWrite):
+                    self._log('Connected serial device "{:s}"!'.format(device.name))
+                else:
+                    self._log_warning('Unable to open serial device "{:s}": {:s}'.format(device.name, device.serial.errorString()))
+                
+            except Exception as e:
+                self._log_exception('Unable to open serial port', e)
+
+        # emit succesful connection signals
+        if any(device.is_open() for device in self.devices):
+            if self.capture_file and self._capture is None:
+                self._capture = KPSerialCaptureWriter(self.capture_file, [device.name for device in self.devices])
+                self._log('Capturing received data to {:s}'.format(self.capture_file))
             self.is_connected = True
             self.connected.emit()
-            
-            self._log('Connected serial port!')
-            
-        except Exception as e:
-            self._log_exception('Unable to open serial port', e)
-
-
-    @pyqtSlot()
-    def read_data(self):
-        rx_bytes = self._serial.readAll()
-
-        #print("len = {:3d}".format(len(self._rx_buffer)))
-        #print(rx_bytes.data())
-
-        for b in rx_bytes.data():
-             self._rx_buffer.append(b)
-
-        '''
-        try:
-            print(self._rx_buffer)
-        except Exception as e:
-            self._log_exception('EXCEPTION! {:s}'.format(str(e)), e)
-        '''
-
-    @pyqtSlot()
-    def parse_rx_buffer(self):
-        msg_size = 0
-
-        if len(self._rx_buffer) >= 1:
-            byte1 = self._rx_buffer[0]
-
-            if byte1 != ord('$'):
-                self._rx_buffer.popleft()
-                return
+            self._stale_timer.start(int(KPSerialInterface.stale_timeout * 500.0))
+            self._start_downlink()
 
-        if len(self._rx_buffer) >= 2:
-            byte2 = self._rx_buffer[1]
 
-            if byte2 != ord('$'):
-                self._rx_buffer.popleft()
-                self._rx_buffer.popleft()
-                return
+    def read_data(self, device):
+        # frames are parsed as soon as their bytes arrive
+        rx_time = time.perf_counter()
+        data = device.serial.readAll().data()
 
-        if len(self._rx_buffer) >= 3:
-            msg_size = self._rx_buffer[2]
+        if self._capture is not None:
+            self._capture.write(device.name, rx_time, data)
 
-        if len(self._rx_buffer) >= (3 + msg_size):
+        self.receive(device, data, rx_time)
 
-            # pop the header
-            self._rx_buffer.popleft()
-            self._rx_buffer.popleft()
-            self._rx_buffer.popleft()
 
-            # pop the message
-            message = []
-            for i in range(msg_size):
-                message.append(self._rx_buffer.popleft())
-
-            self._parse_message(message)
+    def receive(self, device, data, rx_time=None):
+        # received bytes from a device, from its port or a replay
+        if rx_time is None:
+            rx_time = time.perf_counter()
 
+        messages = device.framer.feed(data)
+        for (message_type, values) in messages:
+            self._handle_message(device, message_type, values)
 
+        now = time.perf_counter()
+        latency = now - rx_time
+        device.rx_process_time += latency
+        device.update_frame_rate(now)
+        if len(messages) > 0:
+            device.rx_latency.update(latency)
+            device.rx_latency_max = max(device.rx_latency_max, latency)
 
 
+    @pyqtSlot()
+    def send_downlink(self):
+        # only new telemetry is sent
+        (sequence, values) = self.downlink.get_with_sequence()
+        if sequence == self._downlink_sequence or values is None or not self.is_connected:
+            return
+        self._downlink_sequence = sequence
+
+        (mean_altitude, surface_altitude, vertical_speed, vertical_speed_setpoint, throttle, program_num) = values
+        KPSerialFramer.telemetry_message.pack_into(self._downlink_frame, 3,
+            KPSerialFramer.msg_type_telemetry,
+            mean_altitude,
+            surface_altitude,
+            vertical_speed,
+            vertical_speed_setpoint,
+            int(clamp(0.0, throttle, 1.0) * 255.0),
+            program_num)
+        frame = bytes(self._downlink_frame)
+
+        for device in self.devices:
+            if not device.downlink or not device.is_open():
+                continue
+
+            # never queue behind a previous write the port has not sent yet
+            if device.serial.bytesToWrite() > 0:
+                self.downlink_skipped += 1
+                continue
+
+            device.serial.write(frame)
+            self.downlink_frames += 1
 
         
     @pyqtSlot()
     def disconnect(self):
-        if self._serial is not None:
-            #self._serial.readyRead.disconnect(self)
-            self._serial.close()
-            self._rx_buffer.clear()
+        self._stale_timer.stop()
+
+        if self._replay is not None:
+            self._replay.stop()
+            self._replay = None
             self.is_connected = False
             self.disconnected.emit()
-            self._log('Disconnected serial port')
+            return
+
+        if not any(device.serial is not None for device in self.devices):
+            return
+
+        self._downlink_timer.stop()
+
+        if self._capture is not None:
+            self._capture.close()
+            self._log('Captured {:d} chunks ({:d} bytes) to {:s}'.format(
+                self._capture.chunks, self._capture.bytes, self._capture.filename))
+            self._capture = None
+
+        for device in self.devices:
+            if device.serial is None:
+                continue
+            device.serial.close()
+            device.framer.clear()
+            device_stats = device.stats()
+            self._log('Disconnected serial device "{:s}" ({:d} frames, {:d} resyncs, {:d} bytes dropped, rx latency {:.3f} ms mean, {:.3f} ms max)'.format(
+                device.name,
+                device_stats['frames'], device_stats['resyncs'], device_stats['bytes_dropped'],
+                device_stats['rx_latency_mean'] * 1000.0, device_stats['rx_latency_max'] * 1000.0))
+
+        self.is_connected = False
+        self.disconnected.emit()
+        self._log('Disconnected serial devices ({:d} downlink frames, {:d} skipped)'.format(
+            self.downlink_frames, self.downlink_skipped))
         
     # H E L P E R   F U N C T I O N S 
     #===========================================================================
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import argparse, os, random, threading, time, tty
+
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+from lib.kp_serial_interface import KPSerialFramer, KPSerialInterface
+from lib.kp_tools import LatestValue
+from lib.logger import Logger
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  F U N C T I O N S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+def run_serial_benchmark(frame_rate, baudrate, duration, noise_rate=0.0, corruption_rate=0.0):
+    # Streams simulated frames into a KPSerialInterface for 'duration'
+    # seconds, and returns the link statistics. Latency is measured up to the
+    # rc_state slot the flight controller reads; the flight controller reads
+    # it once per STS tick.
+    app = QCoreApplication.instance()
+    if app is None:
+        app = QCoreApplication([])
+
+    simulator = KPSerialSimulator(frame_rate, baudrate, noise_rate, corruption_rate, seed=0)
+    serial_iface = KPSerialInterface(serial_port=simulator.port_name, serial_baudrate=baudrate)
+    recorder = KPLatencyRecorder(simulator)
+    serial_iface.rc_state = recorder
+
+    serial_iface.connect()
+    simulator.start()
+
+    start_time = time.perf_counter()
+    QTimer.singleShot(int(duration * 1000.0), app.quit)
+    app.exec_()
+    elapsed_time = time.perf_counter() - start_time
+
+    simulator.stop()
+    serial_iface.disconnect()
+    simulator.close()
+
+    link_stats = serial_iface.stats()
+    latencies = sorted(recorder.latencies)
+    num_received = len(latencies)
+
+    results = {
+        'frames_sent'           : simulator.frames_sent,
+        'frames_corrupted'      : simulator.frames_corrupted,
+        'noise_bytes'           : simulator.noise_bytes,
+        'frames_received'       : num_received,
+        'frames_per_second'     : num_received / elapsed_time,
+        'parse_time_per_frame'  : link_stats['rx_process_time'] / max(1, num_received),
+        'latency_mean'          : (sum(latencies) / num_received) if num_received > 0 else None,
+        'latency_p99'           : latencies[int(0.99 * (num_received - 1))] if num_received > 0 else None,
+        'latency_max'           : latencies[-1] if num_received > 0 else None,
+    }
+    results.update({'link_' + key : value for (key, value) in link_stats.items()})
+    return results
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Simulated remote controller
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Streams state messages through a pseudo-terminal, standing in for the
+# hardware controller: KPSerialInterface opens port_name like any serial
+# port. Frames are sent at frame_rate, paced so the byte rate never exceeds
+# what the baud rate allows (10 bits per byte). Frames that fall due
+# together are written in one call.
+#
+# Line noise: with probability noise_rate, random bytes are inserted before a
+# frame; with probability corruption_rate, one byte of a frame is altered.
+#
+# The joystick z value of every frame carries a 16-bit sequence number, and
+# the send time of each sequence number is kept in send_times, so a receiver
+# can measure the latency of every frame. Corruption never alters the
+# sequence number, so frames that still decode are attributed correctly.
+#
+# POSIX only (uses os.openpty).
+class KPSerialSimulator():
+
+    subsys = 'SERIAL_SIM'
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, frame_rate=100.0, baudrate=250000, noise_rate=0.0, corruption_rate=0.0, seed=None):
+        self.frame_rate = frame_rate
+        self.baudrate = baudrate
+        self.noise_rate = noise_rate
+        self.corruption_rate = corruption_rate
+
+        self._random = random.Random(seed)
+        self._terminate = False
+        self._thread = None
+
+        # pseudo-terminal; the slave end is the simulated serial port
+        (self._master_fd, self._slave_fd) = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port_name = os.ttyname(self._slave_fd)
+
+        # statistics
+        self.frames_sent = 0
+        self.frames_corrupted = 0
+        self.noise_bytes = 0
+        self.send_times = [0.0] * 65536
+
+
+    # M E T H O D S
+    #===========================================================================
+    def start(self):
+        self._terminate = False
+        self._thread = threading.Thread(target=self._run, name='serial_simulator', daemon=True)
+        self._thread.start()
+        self._log('Simulating controller on {:s}: {:.0f} frames/s, {:d} baud'.format(
+            self.port_name, self.frame_rate, self.baudrate))
+
+
+    def stop(self):
+        self._terminate = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def close(self):
+        self.stop()
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _run(self):
+        frame_period = 1.0 / self.frame_rate
+        byte_time = 10.0 / self.baudrate
+
+        next_frame_time = time.perf_counter()
+        link_free_time = next_frame_time
+
+        while not self._terminate:
+            now = time.perf_counter()
+
+            # every frame that is due, as far as the link allows
+            data = bytearray()
+            while next_frame_time <= now and link_free_time + len(data) * byte_time <= now:
+                data += self._next_frame(now)
+                next_frame_time += frame_period
+
+            # drop the schedule if the link cannot keep up with the frame rate
+            if next_frame_time < now - 1.0:
+                next_frame_time = now
+
+            if len(data) > 0:
+                os.write(self._master_fd, data)
+                link_free_time = max(link_free_time, now) + len(data) * byte_time
+
+            time.sleep(max(0.0, min(next_frame_time, link_free_time) - time.perf_counter()))
+
+
+    def _next_frame(self, send_time):
+        sequence = self.frames_sent & 0xFFFF
+        self.frames_sent += 1
+        self.send_times[sequence] = send_time
+
+        # slowly sweeping joysticks, switches toggling every few seconds
+        phase = self.frames_sent / self.frame_rate
+        button_state = (int(phase / 4.0) & 0x03)
+        joystick = int(511.5 + 511.5 * ((phase * 0.25) % 2.0 - 1.0))
+
+        frame = bytearray(KPSerialFramer.header)
+        frame.append(KPSerialFramer.state_message.size)
+        frame += KPSerialFramer.state_message.pack(KPSerialFramer.msg_type_state, button_state, joystick, 1023 - joystick, sequence)
+
+        if self._random.random() < self.corruption_rate:
+            frame[self._random.randrange(len(frame) - 2)] = self._random.randrange(256)
+            self.frames_corrupted += 1
+
+        if self._random.random() < self.noise_rate:
+            noise = bytes(self._random.randrange(256) for i in range(self._random.randint(1, 8)))
+            self.noise_bytes += len(noise)
+            frame = noise + frame
+
+        return frame
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _log(self, log_message, log_type='info', log_data=None):
+        Logger.log(KPSerialSimulator.subsys, log_message, log_type, log_data)
+
+
+
+#--- Latency recording slot
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Stands in for KPSerialInterface.rc_state during a benchmark: records the
+# time from a frame being sent to its state being published.
+class KPLatencyRecorder(LatestValue):
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, simulator):
+        super(KPLatencyRecorder, self).__init__()
+        self._simulator = simulator
+        self.latencies = []
+
+
+    # M E T H O D S
+    #===========================================================================
+    def put(self, value):
+        super(KPLatencyRecorder, self).put(value)
+        self.latencies.append(time.perf_counter() - self._simulator.send_times[value.joystick_z])
+
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#  E N T R Y   P O I N T   =#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+if __name__ == '__main__':
+
+    # parse command-line arguments
+    #===========================================================================
+    arg_parser = argparse.ArgumentParser(description="Serial link benchmark against a simulated controller")
+    arg_parser.add_argument("-r", "--rate",
+        help="Frames per second sent by the simulated controller",
+        type=float, default=1000.0)
+    arg_parser.add_argument("-b", "--baudrate",
+        help="Simulated baud rate",
+        type=int, default=250000)
+    arg_parser.add_argument("-d", "--duration",
+        help="Benchmark duration (seconds)",
+        type=float, default=5.0)
+    arg_parser.add_argument("--noise",
+        help="Probability of line noise before a frame",
+        type=float, default=0.0)
+    arg_parser.add_argument("--corruption",
+        help="Probability of a corrupted byte in a frame",
+        type=float, default=0.0)
+    args = arg_parser.parse_args()
+
+    results = run_serial_benchmark(args.rate, args.baudrate, args.duration, args.noise, args.corruption)
+
+    print('Frames sent:       {:d} ({:d} corrupted, {:d} noise bytes)'.format(
+        results['frames_sent'], results['frames_corrupted'], results['noise_bytes']))
+    print('Frames received:   {:d} ({:.0f} frames/s)'.format(
+        results['frames_received'], results['frames_per_second']))
+    print('Resyncs:           {:d} ({:d} bytes dropped)'.format(
+        results['link_resyncs'], results['link_bytes_dropped']))
+    print('Parse CPU:         {:.1f} us/frame'.format(results['parse_time_per_frame'] * 1.0e6))
+    if results['latency_mean'] is not None:
+        print('Latency:           {:.3f} ms mean, {:.3f} ms p99, {:.3f} ms max'.format(
+            results['latency_mean'] * 1000.0, results['latency_p99'] * 1000.0, results['latency_max'] * 1000.0))
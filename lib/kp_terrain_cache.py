@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import collections, math, os
+
+import numpy as np
+
+from lib.logger import Logger
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Persistent terrain height cache
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Read-through cache in front of a body's surface_height RPC. Latitude and
+# longitude are quantised to cells of a fixed ground resolution (the same cell
+# grid as KPRadarMap for the same spacing), and cells are grouped in square
+# tiles. Recently used tiles stay in memory in an LRU; every tile is backed by
+# a memory-mapped file under <cache_dir>/<body>/<resolution>/, so terrain
+# sampled on one flight is served locally on the next. At most max_disk_tiles
+# files are kept; beyond that the least recently used ones are deleted.
+#
+# height() stores what it samples, for lookups near the surface. lookup()
+# reads cached cells but samples anything else directly, without creating
+# tiles, so lookups along a fast or high ground track do not fill the disk.
+# peek() and peek_cells() only read: tiles they need that are not in memory
+# are opened read-only in a separate LRU, so reads never create tile files
+# or evict the tiles being written.
+#
+# Unsampled cells hold NaN.
+class KPTerrainCache():
+
+    subsys = 'TERRAIN'
+    tile_size = 64
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self, body_name, body_radius, sampler, cache_dir=os.path.join('data', 'terrain'), resolution=0.5, max_tiles=64, max_disk_tiles=4096):
+        self.body_name = body_name
+        self.resolution = resolution                # meters
+        self.max_tiles = max_tiles
+        self.max_disk_tiles = max_disk_tiles
+
+        self._sampler = sampler
+        self._cell_deg = math.degrees(resolution / body_radius)
+        self._tile_dir = os.path.join(cache_dir, body_name, '{:g}m'.format(resolution))
+        self._tiles = collections.OrderedDict()
+        self._read_tiles = collections.OrderedDict()    # opened read-only
+        self._missing_tiles = set()                     # keys of tiles with no file
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self._tile_dir, exist_ok=True)
+        self._disk_tiles = 0
+        self._prune_disk()
+
+
+    # M E T H O D S
+    #===========================================================================
+    def height(self, latitude, longitude):
+        # surface height at the cell containing (latitude, longitude),
+        # sampled from the body only if it was never sampled before
+        (tile_y, tile_x, y, x, lat_cell, lon_cell) = self._locate(latitude, longitude)
+        tile = self._get_tile(tile_y, tile_x)
+
+        value = tile[y, x]
+        if value != value:  # NaN
+            value = self._sampler((lat_cell + 0.5) * self._cell_deg, (lon_cell + 0.5) * self._cell_deg)
+            tile[y, x] = value
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return float(value)
+
+
+    def lookup(self, latitude, longitude):
+        # surface height at the cell containing (latitude, longitude), from
+        # the cache if the cell is known, otherwise sampled from the body
+        # without storing it
+        (tile_y, tile_x, y, x, lat_cell, lon_cell) = self._locate(latitude, longitude)
+        tile = self._read_tile(tile_y, tile_x)
+
+        if tile is not None:
+            value = tile[y, x]
+            if value == value:
+                self.hits += 1
+                return float(value)
+
+        self.misses += 1
+        return float(self._sampler((lat_cell + 0.5) * self._cell_deg, (lon_cell + 0.5) * self._cell_deg))
+
+
+    def peek(self, latitude, longitude):
+        # cached surface height, or None; never calls the sampler
+        (tile_y, tile_x, y, x, lat_cell, lon_cell) = self._locate(latitude, longitude)
+        tile = self._read_tile(tile_y, tile_x)
+        if tile is None:
+            return None
+        value = tile[y, x]
+        return None if value != value else float(value)
+
+
+    def peek_cells(self, lat_cells, lon_cells):
+        # cached surface heights of arrays of cells (latitude and longitude
+        # divided by the cell size, rounded down), NaN where unknown; never
+        # calls the sampler
+        heights = np.full(len(lat_cells), np.nan)
+
+        (tile_ys, ys) = np.divmod(lat_cells, KPTerrainCache.tile_size)
+        (tile_xs, xs) = np.divmod(lon_cells, KPTerrainCache.tile_size)
+        tile_keys = tile_ys * (1 << 32) + tile_xs
+
+        for tile_key in np.unique(tile_keys):
+            in_tile = np.flatnonzero(tile_keys == tile_key)
+            tile = self._read_tile(int(tile_ys[in_tile[0]]), int(tile_xs[in_tile[0]]))
+            if tile is not None:
+                heights[in_tile] = tile[ys[in_tile], xs[in_tile]]
+
+        return heights
+
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return (float(self.hits) / lookups) if lookups > 0 else 0.0
+
+
+    def flush(self):
+        for tile in self._tiles.values():
+            tile.flush()
+
+
+    def close(self):
+        self.flush()
+        self._tiles.clear()
+        self._read_tiles.clear()
+        self._log('Closed {:s} terrain cache, {:d} hits, {:d} misses'.format(self.body_name, self.hits, self.misses))
+
+
+    # P R I V A T E   M E T H O D S
+    #===========================================================================
+    def _locate(self, latitude, longitude):
+        lat_cell = int(math.floor(latitude / self._cell_deg))
+        lon_cell = int(math.floor(longitude / self._cell_deg))
+        (tile_y, y) = divmod(lat_cell, KPTerrainCache.tile_size)
+        (tile_x, x) = divmod(lon_cell, KPTerrainCache.tile_size)
+
+        return (tile_y, tile_x, y, x, lat_cell, lon_cell)
+
+
+    def _tile_filename(self, tile_y, tile_x):
+        return os.path.join(self._tile_dir, '{:d}_{:d}.f32'.format(tile_y, tile_x))
+
+
+    def _get_tile(self, tile_y, tile_x):
+        # the tile, loaded or created, for writing
+        key = (tile_y, tile_x)
+
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+
+        # load, or create, the tile file; loading marks the file as used
+        self._read_tiles.pop(key, None)
+        tile_filename = self._tile_filename(tile_y, tile_x)
+        tile_shape = (KPTerrainCache.tile_size, KPTerrainCache.tile_size)
+
+        if os.path.isfile(tile_filename):
+            tile = np.memmap(tile_filename, dtype=np.float32, mode='r+', shape=tile_shape)
+            os.utime(tile_filename)
+        else:
+            tile = np.memmap(tile_filename, dtype=np.float32, mode='w+', shape=tile_shape)
+            tile.fill(np.nan)
+            self._missing_tiles.discard(key)
+            self._disk_tiles += 1
+
+        self._tiles[key] = tile
+
+        # evict the least recently used tile
+        if len(self._tiles) > self.max_tiles:
+            (evicted_key, evicted_tile) = self._tiles.popitem(last=False)
+            evicted_tile.flush()
+
+        if self._disk_tiles > self.max_disk_tiles:
+            self._prune_disk()
+
+        return tile
+
+
+    def _read_tile(self, tile_y, tile_x):
+        # the tile, for reading only; None if it has no file
+        key = (tile_y, tile_x)
+
+        tile = self._tiles.get(key)
+        if tile is not None:
+            return tile
+
+        tile = self._read_tiles.get(key)
+        if tile is not None:
+            self._read_tiles.move_to_end(key)
+            return tile
+
+        if key in self._missing_tiles:
+            return None
+
+        tile_filename = self._tile_filename(tile_y, tile_x)
+        if not os.path.isfile(tile_filename):
+            # bounded: forget every miss once there are many
+            if len(self._missing_tiles) >= 4096:
+                self._missing_tiles.clear()
+            self._missing_tiles.add(key)
+            return None
+
+        tile = np.memmap(tile_filename, dtype=np.float32, mode='r',
+            shape=(KPTerrainCache.tile_size, KPTerrainCache.tile_size))
+        self._read_tiles[key] = tile
+        if len(self._read_tiles) > self.max_tiles:
+            self._read_tiles.popitem(last=False)
+
+        return tile
+
+
+    def _prune_disk(self):
+        # deletes the least recently used tile files, down to 90% of
+        # max_disk_tiles so that pruning does not run on every new tile;
+        # tiles in memory are kept
+        in_memory = set(self._tile_filename(tile_y, tile_x) for (tile_y, tile_x) in list(self._tiles.keys()) + list(self._read_tiles.keys()))
+        tile_files = []
+        for name in os.listdir(self._tile_dir):
+            tile_filename = os.path.join(self._tile_dir, name)
+            if name.endswith('.f32') and tile_filename not in in_memory:
+                try:
+                    tile_files.append((os.path.getmtime(tile_filename), tile_filename))
+                except OSError:
+                    pass
+
+        self._disk_tiles = len(tile_files) + len(in_memory)
+        if self._disk_tiles <= self.max_disk_tiles:
+            return
+
+        tile_files.sort()
+        excess = self._disk_tiles - int(self.max_disk_tiles * 0.9)
+        for (mtime, tile_filename) in tile_files[:excess]:
+            try:
+                os.remove(tile_filename)
+                self._disk_tiles -= 1
+            except OSError:
+                pass
+
+
+    # H E L P E R   F U N C T I O N S
+    #===========================================================================
+    def _log(self, log_message, log_type='info', log_data=None):
+        Logger.log(KPTerrainCache.subsys, log_message, log_type, log_data)
@@ -39,7 +39,15 @@ def vector_project_onto_plane(x, n):
     d = vector_dot_product(x, n) / vector_length(n)
     p = [d * n_normalized[i] for i in range(len(n))]
     return [x[i] - p[i] for i in range(len(x))]
-    
+
+def vector_cross_product(x, y):
+    return [x[1] * y[2] - x[2] * y[1], x[2] * y[0] - x[0] * y[2], x[0] * y[1] - x[1] * y[0]]
+
+def quaternion_rotate(q, v):
+    # rotates vector v by the unit quaternion q = (x, y, z, w), as returned by KRPC
+    t = vector_scale(vector_cross_product(q[:3], v), 2.0)
+    return vector_add(vector_add(v, vector_scale(t, q[3])), vector_cross_product(q[:3], t))
+
 def clamp(val_min, value, val_max):
     return max(val_min, min(val_max, value))
     
@@ -57,6 +65,93 @@ def mean(values_list):
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 
+#--- Clock classes
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Everything that needs a notion of "now" for control purposes (PID delta_t,
+# state variable timing, the flight schedulers, time plots) reads it from a
+# clock object instead of calling time.time() directly. This allows control to
+# follow game time, and offline runs to step a simulated clock as fast as the
+# CPU allows.
+class Clock():
+
+    name = 'clock'
+
+    def time(self):
+        raise NotImplementedError
+
+
+class WallClock(Clock):
+
+    name = 'wall'
+
+    def time(self):
+        return time.time()
+
+
+class MonotonicClock(Clock):
+
+    name = 'monotonic'
+
+    def time(self):
+        return time.monotonic()
+
+
+class GameClock(Clock):
+
+    name = 'game'
+
+    # C O N S T R U C T O R 
+    #===========================================================================
+    def __init__(self, ut_source=None):
+        self._ut_source = ut_source
+        self._ut = 0.0
+
+    # M E T H O D S 
+    #===========================================================================
+    def set_source(self, ut_source):
+        # ut_source is any callable returning the game universal time, such as
+        # a KRPC stream. While there is no source, time stands still.
+        self._ut_source = ut_source
+
+    def time(self):
+        if self._ut_source is not None:
+            self._ut = self._ut_source()
+        return self._ut
+
+
+class SimulatedClock(Clock):
+
+    name = 'simulated'
+
+    # C O N S T R U C T O R 
+    #===========================================================================
+    def __init__(self, start_time=0.0):
+        self._time = start_time
+
+    # M E T H O D S 
+    #===========================================================================
+    def time(self):
+        return self._time
+
+    def set(self, current_time):
+        self._time = current_time
+
+    def advance(self, delta_t):
+        self._time += delta_t
+        return self._time
+
+
+def create_clock(clock_name):
+    clocks = {
+        WallClock.name      : WallClock,
+        MonotonicClock.name : MonotonicClock,
+        GameClock.name      : GameClock,
+        SimulatedClock.name : SimulatedClock,
+    }
+    return clocks[clock_name]()
+
+
+
 #--- State Variable Register class
 #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
 class StateVariable():
@@ -64,14 +159,20 @@ class StateVariable():
 
     # C O N S T R U C T O R 
     #===========================================================================
-    def __init__(self, initial_value=None, register_size=2):
+    def __init__(self, initial_value=None, register_size=2, clock=None):
         register_size = max(2, register_size) # minimum register size is 2
         self._shift_register = collections.deque(maxlen=register_size)
         self._data_class = None
 
+        # optional timing: when a clock is given, every update is timestamped
+        self._clock = clock
+        self._time_register = collections.deque(maxlen=register_size)
+
         if initial_value is not None:
             self._shift_register.append(initial_value)
             self._data_class = initial_value.__class__
+            if self._clock is not None:
+                self._time_register.append(self._clock.time())
         
         
     # M E T H O D S 
@@ -91,6 +192,20 @@ class StateVariable():
 
         if isinstance(current_value, self._data_class):
             self._shift_register.append(current_value)
+            if self._clock is not None:
+                self._time_register.append(self._clock.time())
+
+    def get_time(self):
+        return self._time_register[-1] if (len(self._time_register) > 0) else None
+
+    def delta_time(self):
+        return (self._time_register[-1] - self._time_register[-2]) if (len(self._time_register) > 1) else None
+
+    def rate(self):
+        # rate of change of the value, per unit of clock time
+        delta = self.delta()
+        delta_t = self.delta_time()
+        return (delta / delta_t) if (delta is not None and delta_t is not None and delta_t > 0.0) else None
 
     def delta(self):
         return (self._shift_register[-1] - self._shift_register[-2]) if ((len(self._shift_register) > 1) and ((self._data_class == float) or (self._data_class == int))) else None
@@ -125,13 +240,45 @@ class StateVariable():
 
 
 
+#--- Latest value slot
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Single-writer handoff of the most recent value between schedulers or
+# threads. Writers overwrite, readers take whatever is newest. The slot holds
+# one immutable (sequence, value) tuple, and replacing it is a single atomic
+# attribute store, so no lock is needed.
+class LatestValue():
+
+    # C O N S T R U C T O R 
+    #===========================================================================
+    def __init__(self, initial_value=None):
+        self._slot = (0, initial_value)
+        
+        
+    # M E T H O D S 
+    #===========================================================================
+    def put(self, value):
+        self._slot = (self._slot[0] + 1, value)
+
+    def get(self):
+        return self._slot[1]
+
+    def get_with_sequence(self):
+        return self._slot
+
+    def clear(self):
+        self.put(None)
+
+
+
+
+
 #--- Basic PID controller class
 #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
 class PidController():
 
     # C O N S T R U C T O R 
     #===========================================================================
-    def __init__(self, kp, ki, kd, output_min, output_max, set_point):
+    def __init__(self, kp, ki, kd, output_min, output_max, set_point, clock=None):
     
         # modifiable settings
         self.kp = kp
@@ -140,25 +287,33 @@ class PidController():
         self.output_min = output_min
         self.output_max = output_max
         self.set_point = set_point
+        self._clock = clock if clock is not None else MonotonicClock()
         
         # internal variables
         self._integral = 0.0
         self._prev_value = 0.0
         self._prev_error = 0.0
-        self._previous_time = time.time()
+        self._previous_time = self._clock.time()
         self._u = 0.0
+        self._p_value = 0.0
+        self._i_value = 0.0
+        self._d_value = 0.0
         
         # TODO: integral wind-up reset?
         
         
     # M E T H O D S 
     #===========================================================================
+    def set_clock(self, clock):
+        self._clock = clock
+        self._previous_time = self._clock.time()
+
     def update(self, current_value):
         # update the times
         # note: this controller works best when this update function is called
         # periodically on a consistent period
         #
-        current_time = time.time()
+        current_time = self._clock.time()
         delta_t = current_time - self._previous_time
         
         if delta_t > 0.0:
@@ -189,6 +344,10 @@ class PidController():
             
             # debug output
             #print('p = {:8.3f}, i = {:8.3f}, d = {:8.3f}, PID = {:8.3f}'.format(self._p_value, self._i_value, self._d_value, u))
+            
+        elif delta_t < 0.0:
+            # the clock went backwards (e.g. game time after a quickload)
+            self._previous_time = current_time
         
         return self._u
         
@@ -196,32 +355,53 @@ class PidController():
 
 #--- Remote controller state definition
 #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
-class KPRemoteControlState(QtCore.QObject):
+# Immutable snapshot of the remote controller, built once per received state
+# message and handed to the flight controller through a LatestValue slot.
+# button_presses counts the presses of each button (by bit) since the link
+# started, so that a reader that skips states can still see every press.
+class KPRemoteControlState():
+
+    button_count = 7
+
+    __slots__ = (
+        'button_state',
+        'joystick_x',
+        'joystick_y',
+        'joystick_z',
+        'btn_switch_red',
+        'btn_switch_blue',
+        'btn_pushbtn_red',
+        'btn_pushbtn_green',
+        'btn_rocker_up',
+        'btn_rocker_down',
+        'btn_joystick',
+        'button_presses',
+    )
 
     # C O N S T R U C T O R 
     #===========================================================================
-    def __init__(self, button_state=0, joystick_x=0, joystick_y=0, joystick_z=0, **kwds):
-        super(KPRemoteControlState, self).__init__(**kwds)
-
-        self._button_state = button_state
-        self.joystick = {}
-        self.joystick['x'] = joystick_x
-        self.joystick['y'] = joystick_y
-        self.joystick['z'] = joystick_z
+    def __init__(self, button_state=0, joystick_x=0, joystick_y=0, joystick_z=0, button_presses=None):
+        init = super(KPRemoteControlState, self).__setattr__
+        init('button_state', button_state)
+        init('button_presses', button_presses if button_presses is not None else (0,) * KPRemoteControlState.button_count)
+        init('joystick_x', joystick_x)
+        init('joystick_y', joystick_y)
+        init('joystick_z', joystick_z)
 
         # unpack button states
-        self.set_button_states(button_state)
+        init('btn_switch_red',      (button_state & (1 << 0)) != 0)
+        init('btn_switch_blue',     (button_state & (1 << 1)) != 0)
+        init('btn_pushbtn_red',     (button_state & (1 << 2)) != 0)
+        init('btn_pushbtn_green',   (button_state & (1 << 3)) != 0)
+        init('btn_rocker_up',       (button_state & (1 << 4)) != 0)
+        init('btn_rocker_down',     (button_state & (1 << 5)) != 0)
+        init('btn_joystick',        (button_state & (1 << 6)) != 0)
 
-    def set_button_states(self, button_state):
-        self._button_state      = button_state
-        self.btn_switch_red     = (button_state & (1 << 0)) != 0
-        self.btn_switch_blue    = (button_state & (1 << 1)) != 0
-        self.btn_pushbtn_red    = (button_state & (1 << 2)) != 0
-        self.btn_pushbtn_green  = (button_state & (1 << 3)) != 0
-        self.btn_rocker_up      = (button_state & (1 << 4)) != 0
-        self.btn_rocker_down    = (button_state & (1 << 5)) != 0
-        self.btn_joystick       = (button_state & (1 << 6)) != 0
 
+    # M E T H O D S 
+    #===========================================================================
+    def __setattr__(self, name, value):
+        raise AttributeError('KPRemoteControlState is immutable')
 
     def get_joystick(self, axis):
-        return self.joystick[axis]
+        return getattr(self, 'joystick_' + axis)
@@ -3,54 +3,362 @@
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
-import json, os, sys, threading, time
+import collections, gzip, json, os, shutil, sys, threading, time
 
 if sys.version_info >= (3,0):
     isPython3 = True
-    import queue
     from queue import Queue
 else:
     isPython3 = False
-    import Queue
     from Queue import Queue
 
 from time import sleep
 from threading import Lock
 
+from lib.kp_binary_log import KPBinaryLogEncoder, binary_log_magic, index_filename
+
 
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
 
+#--- Log entry ring buffer
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Bounded buffer between the threads that log and the logger thread. put()
+# never blocks: when the buffer is full, the overflow policy discards either
+# the oldest queued entry ('drop_oldest') or the new one ('drop_newest'), and
+# the discarded entry is counted. deque appends and pops are atomic, so
+# producers take no lock.
+class LogRingBuffer():
+
+    overflow_policies = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, capacity=4096, overflow='drop_oldest'):
+        if overflow not in LogRingBuffer.overflow_policies:
+            raise ValueError('Unknown log overflow policy: {}'.format(overflow))
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+
+        self._drop_newest = (overflow == 'drop_newest')
+        self._entries = collections.deque(maxlen=capacity)
+        self._ready = threading.Event()
+
+
+    def put(self, entry):
+        # returns False if the entry was discarded
+        if len(self._entries) >= self.capacity:
+            self.dropped += 1
+            if self._drop_newest:
+                return False
+
+        # a full deque discards its oldest entry
+        self._entries.append(entry)
+        if not self._ready.is_set():
+            self._ready.set()
+        return True
+
+
+    def pop_batch(self, max_entries):
+        entries = []
+        try:
+            while len(entries) < max_entries:
+                entries.append(self._entries.popleft())
+        except IndexError:
+            pass
+        return entries
+
+
+    def wait(self, timeout=None):
+        # waits until entries may be available; clears the ready flag first,
+        # so entries put while the caller drains set it again
+        self._ready.wait(timeout)
+        self._ready.clear()
+
+
+    def wake(self):
+        self._ready.set()
+
+
+    def extend(self, entries):
+        for entry in entries:
+            self.put(entry)
+
+
+    def clear(self):
+        self._entries.clear()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+
+#--- Repeated log entry
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Repeats of one message template and the same non-numeric arguments (names
+# and the like) within an aggregation window: their count, the last
+# arguments, and the minimum and maximum of each numeric argument (None for
+# other arguments).
+class LogRepeat():
+
+    __slots__ = ('start_time', 'log_type', 'log_data', 'count', 'last_args', 'minimums', 'maximums')
+
+    def __init__(self, start_time, log_type, log_data, log_args):
+        self.start_time = start_time
+        self.log_type = log_type
+        self.log_data = log_data
+        self.count = 0
+        self.last_args = log_args
+        self.minimums = [value if isinstance(value, (float, int)) else None for value in log_args]
+        self.maximums = list(self.minimums)
+
+
+    def update(self, log_data, log_args):
+        self.count += 1
+        self.log_data = log_data
+        self.last_args = log_args
+        for (i, value) in enumerate(log_args):
+            if self.minimums[i] is not None:
+                if value < self.minimums[i]:
+                    self.minimums[i] = value
+                elif value > self.maximums[i]:
+                    self.maximums[i] = value
+
+
+
+#--- Rotated log archiver
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Compresses rotated log segments and enforces the retention limits, on its
+# own thread so the logger thread never waits for it. Segments are named
+# '<log name>.<YYYYmmdd-HHMMSS-mmm>', with the binary log index alongside; once
+# compressed, each file gets a '.gz' suffix. Only the newest keep_segments
+# segments are kept (0 for no limit), and segments older than keep_days are
+# deleted (0 for no limit).
+class LogArchiver(threading.Thread):
+
+    def __init__(self, log_full_filename, compress=True, keep_segments=10, keep_days=0.0):
+        threading.Thread.__init__(self, name='log_archiver')
+        self.daemon = True
+
+        self.log_dir = os.path.dirname(log_full_filename) or os.curdir
+        self.segment_prefix = os.path.basename(log_full_filename) + '.'
+        self.compress = compress
+        self.keep_segments = keep_segments
+        self.keep_days = keep_days
+
+        self.errors = []
+        self._segments = Queue()
+
+
+    def run(self):
+        while True:
+            segment_files = self._segments.get()
+            if segment_files is None:
+                break
+
+            try:
+                if self.compress:
+                    for filename in segment_files:
+                        self._compress(filename)
+                self._prune()
+            except (IOError, OSError) as e:
+                self.errors.append('{:s}: {:s}'.format(e.__class__.__name__, str(e)))
+
+
+    def archive(self, segment_files):
+        self._segments.put(segment_files)
+
+
+    def finish(self):
+        # archives the queued segments, then stops
+        self._segments.put(None)
+        self.join()
+
+
+    def segment_name(self, segment_time):
+        # a name no other segment has; names sort in time order
+        while True:
+            name = '{:s}{:s}-{:03d}'.format(
+                self.segment_prefix,
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(segment_time)),
+                int((segment_time % 1.0) * 1000.0))
+            if not any(os.path.exists(os.path.join(self.log_dir, name + suffix)) for suffix in ('', '.gz')):
+                return os.path.join(self.log_dir, name)
+            segment_time += 0.001
+
+
+    def _compress(self, filename):
+        with open(filename, 'rb') as source:
+            with gzip.open(filename + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+        # keep the segment's age for keep_days, rather than the compression time
+        shutil.copystat(filename, filename + '.gz')
+        os.remove(filename)
+
+
+    def _prune(self):
+        # files of each segment, by segment name
+        segments = {}
+        for filename in os.listdir(self.log_dir):
+            segment = filename[len(self.segment_prefix):].split('.')[0]
+            # the active log's own files (such as its index) are not segments
+            if filename.startswith(self.segment_prefix) and segment[:8].isdigit():
+                segments.setdefault(segment, []).append(os.path.join(self.log_dir, filename))
+
+        # segment names sort by time, newest last
+        names = sorted(segments)
+        expired = []
+        if self.keep_segments > 0:
+            expired += names[:-self.keep_segments]
+        if self.keep_days > 0.0:
+            oldest_time = time.time() - self.keep_days * 86400.0
+            expired += [name for name in names
+                if max(os.path.getmtime(filename) for filename in segments[name]) < oldest_time]
+
+        for name in set(expired):
+            for filename in segments[name]:
+                os.remove(filename)
+
+
+
 #--- General logging functionality
 #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Log entries are queued by any thread and written by the logger thread. The
+# logger thread blocks on the queue, then drains up to batch_size entries at
+# a time and writes them as JSON lines through one buffered file handle that
+# stays open while it runs. The file is flushed once flush_size bytes are
+# pending, or flush_interval seconds after the first unflushed write. The
+# fsync policy decides when flushed data is also forced to disk:
+#
+#   'never'   left to the operating system
+#   'close'   when the logger terminates
+#   'flush'   on every flush
+#
+# Entries are written as JSON lines, or with log_format 'binary' in the
+# compact format of lib/kp_binary_log.py, with a sidecar index.
+#
+# Logging never blocks the caller: the queue is a LogRingBuffer of
+# queue_size entries with the given overflow policy. Discarded entries are
+# reported in a warning every drop_report_interval seconds.
+#
+# Entries below the log level ('debug', 'info', 'warning', 'error') are
+# discarded before any other work. Callers can pass a message template and
+# log_args instead of a formatted message: the logger thread formats it, and
+# also prints to the console in debug mode, so the calling thread only
+# queues a tuple.
+#
+# Warnings and errors logged with log_args are aggregated: the first entry
+# of a subsystem, message template and set of non-numeric arguments is
+# logged, and repeats of it within the next aggregate_window seconds are
+# only counted. When the window expires, the logger thread writes one
+# summary entry with the repeat count, the last arguments and each numeric
+# argument's minimum and maximum.
+#
+# The log is rotated when it reaches rotate_size bytes (0 to disable), and
+# with rotate_on_start when a session starts on a non-empty log. Rotated
+# segments are compressed and pruned by a LogArchiver.
 class Logger(threading.Thread):
 
     subsys = 'LOGGER'
     
-    log_queue = Queue(500)
+    log_queue = LogRingBuffer()
     log_lock = Lock()
     debug = False
 
-    def __init__(self, log_name, log_dir=os.getcwd(), debug_on=False):
+    fsync_policies = ('never', 'close', 'flush')
+    log_formats = ('json', 'binary')
+    
+    # log levels, by log type; other types are logged at the 'info' level
+    levels = {
+        'debug'     : 10,
+        'info'      : 20,
+        'warning'   : 30,
+        'error'     : 40,
+        'exception' : 40,
+    }
+    level = levels['info']
+    
+    # repeated entry aggregation, by (subsystem, message template)
+    aggregate_types = ('warning', 'error')
+    aggregate_window = 0.0
+    _repeats = {}
+
+    def __init__(self, log_name, log_dir=os.getcwd(), debug_on=False,
+            batch_size=256,
+            flush_size=65536,
+            flush_interval=1.0,
+            fsync='close',
+            queue_size=4096,
+            overflow='drop_oldest',
+            drop_report_interval=5.0,
+            log_format='json',
+            rotate_size=0,
+            rotate_on_start=False,
+            compress=True,
+            keep_segments=10,
+            keep_days=0.0,
+            level='info',
+            aggregate_window=5.0):
         threading.Thread.__init__(self)
         self.log_start_time = time.time()
-        self._log_sleep_time = 0.050 # seconds
         self.stop = threading.Event()
         self.stop.clear()
         
         self.log_full_filename = os.path.join(log_dir, log_name)
         
+        if fsync not in Logger.fsync_policies:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        if log_format not in Logger.log_formats:
+            raise ValueError('Unknown log format: {}'.format(log_format))
+        self.log_format = log_format
+        self.batch_size = batch_size
+        self.flush_size = flush_size            # bytes
+        self.flush_interval = flush_interval    # seconds
+        self.fsync = fsync
+        
+        self.rotate_size = rotate_size          # bytes
+        self.rotate_on_start = rotate_on_start
+        self._archiver = LogArchiver(self.log_full_filename, compress, keep_segments, keep_days)
+        
+        self._log_file = None
+        self._index_file = None
+        self._binary_encoder = None
+        self._log_offset = 0
+        self._pending_bytes = 0
+        self._flush_deadline = None
+        
+        # entries logged before the logger was created are kept
+        queued_entries = Logger.log_queue.pop_batch(len(Logger.log_queue))
+        Logger.log_queue = LogRingBuffer(queue_size, overflow)
+        Logger.log_queue.extend(queued_entries)
+        self.drop_report_interval = drop_report_interval    # seconds
+        self._drops_reported = 0
+        self._drop_report_time = time.time()
+        
+        # local time string of the last second formatted
+        self._localtime_second = None
+        self._localtime_str = None
+        
         Logger.debug = debug_on
+        Logger.set_level(level)
+        Logger.aggregate_window = aggregate_window      # seconds, 0 to disable
         
         
     def run(self):
     
-        # check if the log file already exists
-        log_file_exists = os.path.isfile(self.log_full_filename)
+        self._archiver.start()
+        
+        # check if the log file already exists; a new session can start a
+        # new log, and a log in the other format is never appended to
+        log_file_exists = os.path.isfile(self.log_full_filename) and os.path.getsize(self.log_full_filename) > 0
+        if log_file_exists and (self.rotate_on_start or not self._has_log_format(self.log_full_filename)):
+            self._rotate_files(os.path.getmtime(self.log_full_filename))
+            log_file_exists = False
+        self._open_files()
     
         # log a start message
-        Logger.log(Logger.subsys,
+        self._log(
             'Logger initialized, {:s}: "{:s}"'.format(
                 "appending to" if log_file_exists else "created", 
                 self.log_full_filename))
@@ -58,50 +366,85 @@ class Logger(threading.Thread):
         # start main logging loop
         while not self.is_terminated():
             
-            # check if any messages to log
-            self.flush_queue()
-                        
-            sleep(self._log_sleep_time)
+            # wait for entries, or until the pending data or a drop report
+            # is due
+            deadline = self._drop_report_time + self.drop_report_interval
+            if self._flush_deadline is not None:
+                deadline = min(deadline, self._flush_deadline)
+            if len(Logger._repeats) > 0:
+                deadline = min(deadline, self._repeats_deadline())
+            Logger.log_queue.wait(max(0.0, deadline - time.time()))
+            
+            log_entries = self.drain_queue()
+            while len(log_entries) > 0:
+                self.write_entries(log_entries)
+                if self._pending_bytes >= self.flush_size:
+                    self.flush_file()
+                log_entries = self.drain_queue()
+            
+            current_time = time.time()
+            if current_time >= self._drop_report_time + self.drop_report_interval:
+                self.report_drops()
+            
+            if len(Logger._repeats) > 0:
+                self.report_repeats(current_time)
             
-        # before terminating, log a message, flush the queue
-        Logger.log(self.subsys, 'Logger terminating ...')
+            if self._flush_deadline is not None and current_time >= self._flush_deadline:
+                self.flush_file()
+            
+        # before terminating, flush the queue, log a message
         self.flush_queue()
+        self.report_drops()
+        self.report_repeats()
+        self._log('Logger terminating ...')
+        self.flush_file(fsync=(self.fsync != 'never'))
+        self._close_files()
+        self._archiver.finish()
+        for error in self._archiver.errors:
+            sys.stderr.write('Warning: log archiving failed: {:s}\n'.format(error))
         
                     
     @staticmethod
-    def log(log_subsys, log_message, log_type='info', log_data=None):
-        current_time = time.time()
+    def log(log_subsys, log_message, log_type='info', log_data=None, log_args=None):
+        if Logger.levels.get(log_type, 20) < Logger.level:
+            return
         
-        # form log entry dictionary
-        log_entry = {
-            'time'      : current_time,
-            'subsys'    : log_subsys,
-            'type'      : log_type,
-            'message'   : log_message,
-        }
-        if log_data is not None:
-            log_dict = dict(log_entry, **log_data)
-        else:
-            log_dict = log_entry
-            
-        if Logger.debug:
-            print("LOG {:s} | {:s}".format(time.strftime("%H:%M:%S", time.localtime(current_time)), log_message))
+        # repeats of a recent warning or error are only counted
+        if log_args is not None and Logger.aggregate_window > 0.0 and log_type in Logger.aggregate_types:
+            # with positions, so that repeats have numbers in the same places,
+            # and as strings, so that any argument can be part of the key
+            key = (log_subsys, log_message, len(log_args)) + tuple(
+                (i, str(value)) for (i, value) in enumerate(log_args) if not isinstance(value, (float, int)))
+            with Logger.log_lock:
+                repeat = Logger._repeats.get(key)
+                if repeat is not None:
+                    repeat.update(log_data, log_args)
+                    return
+                Logger._repeats[key] = LogRepeat(time.time(), log_type, log_data, log_args)
+        
+        # place in queue; never blocks, full queues drop entries. The entry
+        # is completed by the logger thread.
+        Logger.log_queue.put((time.time(), log_subsys, log_type, log_message, log_args, log_data))
+        
+        
+    @staticmethod
+    def set_level(level):
+        Logger.level = Logger.levels[level]
         
-        # attempt to place in queue
-        try:
-            Logger.log_queue.put(log_dict)
-        except Queue.Full as e:
-            sys.stderr.write('Warning: log queue full, discarding message: "{:s}"\n'.format(log_message))
         
+    @staticmethod
+    def is_enabled(log_type):
+        # for callers that need work to build a log entry at all
+        return Logger.levels.get(log_type, 20) >= Logger.level
         
                     
     @staticmethod
-    def log_error(log_subsys, log_message, log_data=None):
-        Logger.log(log_subsys, log_message, 'error', log_data)
+    def log_error(log_subsys, log_message, log_data=None, log_args=None):
+        Logger.log(log_subsys, log_message, 'error', log_data, log_args)
                     
     @staticmethod
-    def log_warning(log_subsys, log_message, log_data=None):
-        Logger.log(log_subsys, log_message, 'warning', log_data)
+    def log_warning(log_subsys, log_message, log_data=None, log_args=None):
+        Logger.log(log_subsys, log_message, 'warning', log_data, log_args)
         
                     
     @staticmethod
@@ -115,34 +458,122 @@ class Logger(threading.Thread):
     
         
         
-    def flush_queue(self):
-        # check number of messages in queue
-        num_log_entries = self.log_queue.qsize()
+    def drain_queue(self):
+        # up to batch_size queued entries, without waiting, as dictionaries
+        return [self._log_entry(*queued_entry) for queued_entry in Logger.log_queue.pop_batch(self.batch_size)]
         
-        if num_log_entries > 0:
         
-            # open the log file
-            with open(self.log_full_filename, 'ab') as log_file:
+    def report_drops(self):
+        # entries discarded by the queue since the last report
+        dropped = Logger.log_queue.dropped
+        if dropped > self._drops_reported:
+            self._log('Log queue full, {:d} entries dropped ({:s}, {:d} in total)'.format(
+                    dropped - self._drops_reported, Logger.log_queue.overflow, dropped),
+                'warning',
+                {'dropped' : dropped - self._drops_reported, 'dropped_total' : dropped})
+            self._drops_reported = dropped
+        self._drop_report_time = time.time()
         
-                for i in range(num_log_entries):
-                    log_entry = self.log_queue.get()
-                    
-                    # append extra log information
-                    current_time = log_entry['time']
-                    current_time_str = time.asctime(time.localtime(current_time))
-                    log_entry['localtime'] = current_time_str
-                    
-                    # log the message as a JSON string
-                    if isPython3:
-                        log_file.write(bytes(json.dumps(log_entry) + "\n", 'UTF-8'))
-                    else:
-                        log_file.write(json.dumps(log_entry) + "\n")
+        
+    def report_repeats(self, current_time=None):
+        # summaries of the aggregation windows that have expired, or of all
+        # of them without a current_time
+        with Logger.log_lock:
+            expired = [key for (key, repeat) in Logger._repeats.items()
+                if current_time is None or current_time >= repeat.start_time + Logger.aggregate_window]
+            repeats = [(key, Logger._repeats.pop(key)) for key in expired]
+        
+        log_entries = []
+        for (key, repeat) in repeats:
+            (log_subsys, log_message) = key[:2]
+            if repeat.count == 0:
+                continue
+            
+            repeat_data = {
+                'repeat_count'  : repeat.count,
+                'repeat_time'   : time.time() - repeat.start_time,
+                'args_last'     : [value if isinstance(value, (float, int)) else str(value) for value in repeat.last_args],
+                'args_min'      : repeat.minimums,
+                'args_max'      : repeat.maximums,
+            }
+            if repeat.log_data is not None:
+                repeat_data.update(repeat.log_data)
+            
+            log_entry = self._log_entry(time.time(), log_subsys, repeat.log_type, log_message, repeat.last_args, repeat_data)
+            log_entry['message'] += ' (repeated {:d} times in {:.1f} s)'.format(repeat.count, repeat_data['repeat_time'])
+            log_entries.append(log_entry)
+        
+        self.write_entries(log_entries)
+        
+        
+    def write_entries(self, log_entries):
+        if len(log_entries) == 0:
+            return
+        
+        if Logger.debug:
+            sys.stdout.write(''.join('LOG {:s} | {:s}\n'.format(
+                    time.strftime("%H:%M:%S", time.localtime(log_entry['time'])), log_entry['message'])
+                for log_entry in log_entries))
+        
+        if self._binary_encoder is not None:
+            # one block per batch, and its index record
+            (data, index_data) = self._binary_encoder.encode(log_entries, self._log_offset)
+            self._index_file.write(index_data)
+        
+        else:
+            lines = []
+            for log_entry in log_entries:
+                # append extra log information
+                log_entry['localtime'] = self._localtime(log_entry['time'])
+                lines.append(json.dumps(log_entry))
+            
+            # log the messages as JSON strings, one write per batch
+            data = ('\n'.join(lines) + '\n').encode('UTF-8')
+        
+        self._log_file.write(data)
+        self._log_offset += len(data)
+        self._pending_bytes += len(data)
+        if self._flush_deadline is None:
+            self._flush_deadline = time.time() + self.flush_interval
+        
+        if self.rotate_size > 0 and self._log_offset >= self.rotate_size:
+            self.rotate()
+        
+        
+    def rotate(self):
+        # closes the current log as a segment and starts a new one
+        self.flush_file(fsync=(self.fsync != 'never'))
+        self._close_files()
+        segment_name = self._rotate_files(time.time())
+        self._open_files()
+        self._log('Log rotated, previous segment: "{:s}"'.format(segment_name))
+        
+        
+    def flush_queue(self):
+        # write every queued entry
+        log_entries = self.drain_queue()
+        while len(log_entries) > 0:
+            self.write_entries(log_entries)
+            log_entries = self.drain_queue()
+            
+            
+    def flush_file(self, fsync=None):
+        if fsync is None:
+            fsync = (self.fsync == 'flush')
+        
+        for log_file in (self._log_file, self._index_file):
+            if log_file is None:
+                continue
+            log_file.flush()
+            if fsync:
+                os.fsync(log_file.fileno())
+        self._pending_bytes = 0
+        self._flush_deadline = None
     
     
     @staticmethod
     def clear_queue():
-        while not Logger.log_queue.empty():
-            Logger.log_queue.get()
+        Logger.log_queue.clear()
         
         
     def is_terminated(self):
@@ -150,4 +581,94 @@ class Logger(threading.Thread):
     
     def terminate(self):
         self.stop.set()
-        
\ No newline at end of file
+        
+        # wake the logger thread if it is waiting for an entry
+        Logger.log_queue.wake()
+        
+        
+    def _has_log_format(self, filename):
+        # whether an existing log file is in log_format
+        with open(filename, 'rb') as log_file:
+            is_binary = (log_file.read(len(binary_log_magic)) == binary_log_magic)
+        return is_binary == (self.log_format == 'binary')
+        
+        
+    def _open_files(self):
+        self._log_file = open(self.log_full_filename, 'ab')
+        self._log_offset = self._log_file.tell()
+        new_log_file = (self._log_offset == 0)
+        
+        if self.log_format == 'binary':
+            self._index_file = open(index_filename(self.log_full_filename), 'ab')
+            new_index_file = (self._index_file.tell() == 0)
+            self._binary_encoder = KPBinaryLogEncoder()
+            (data, index_data) = self._binary_encoder.start_session(new_log_file, new_index_file)
+            self._log_file.write(data)
+            self._index_file.write(index_data)
+            self._log_offset += len(data)
+        
+        
+    def _rotate_files(self, segment_time):
+        # renames the (closed) log files, and hands them to the archiver
+        segment_name = self._archiver.segment_name(segment_time)
+        segment_files = []
+        for (filename, segment_filename) in (
+                (self.log_full_filename, segment_name),
+                (index_filename(self.log_full_filename), index_filename(segment_name))):
+            if os.path.isfile(filename):
+                os.rename(filename, segment_filename)
+                segment_files.append(segment_filename)
+        self._archiver.archive(segment_files)
+        return segment_name
+        
+        
+    def _close_files(self):
+        for log_file in (self._log_file, self._index_file):
+            if log_file is not None:
+                log_file.close()
+        self._log_file = None
+        self._index_file = None
+        self._binary_encoder = None
+        
+        
+    def _repeats_deadline(self):
+        # when the oldest aggregation window expires
+        with Logger.log_lock:
+            start_times = [repeat.start_time for repeat in Logger._repeats.values()]
+        return (min(start_times) if len(start_times) > 0 else time.time()) + Logger.aggregate_window
+        
+        
+    def _log_entry(self, entry_time, log_subsys, log_type, log_message, log_args, log_data):
+        # log entry dictionary, with its message formatted
+        if log_args is not None:
+            # any error in a caller's template or arguments is logged, and
+            # must not stop the logger thread
+            try:
+                log_message = log_message.format(*log_args)
+            except Exception as e:
+                log_message = '{:s} {!r} (format error: {:s})'.format(log_message, tuple(log_args), str(e))
+        
+        log_entry = {
+            'time'      : entry_time,
+            'subsys'    : log_subsys,
+            'type'      : log_type,
+            'message'   : log_message,
+        }
+        if log_data is not None:
+            log_entry.update(log_data)
+        return log_entry
+        
+        
+    def _log(self, log_message, log_type='info', log_data=None):
+        # the logger thread's own messages are written directly, so they
+        # cannot be dropped
+        self.write_entries([self._log_entry(time.time(), Logger.subsys, log_type, log_message, None, log_data)])
+        
+        
+    def _localtime(self, current_time):
+        # time.asctime() only changes once per second
+        second = int(current_time)
+        if second != self._localtime_second:
+            self._localtime_second = second
+            self._localtime_str = time.asctime(time.localtime(current_time))
+        return self._localtime_str
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=  I M P O R T   #=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+import numpy as np
+
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+from PyQt5.QtWidgets import QWidget
+
+
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#  C L A S S E S   =#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=#=
+
+#--- Height map display
+#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-
+# Renders a 2-D grid of heights as an image. Heights are binned between the
+# grid's minimum and maximum and mapped through a colour lookup table in one
+# NumPy pass; the resulting image is drawn scaled to the widget, one block per
+# cell. Cells within 'highlightBand' of the reference height are drawn in the
+# highlight colour, unknown (NaN) cells in the background colour. Row 0 of the
+# grid is drawn at the bottom, so north is up for radar frames.
+class QHeatmap(QWidget):
+
+    # C O N S T R U C T O R
+    #===========================================================================
+    def __init__(self,
+            colorBins=60,
+            hueMin=0.0,
+            hueMax=0.2,
+            highlightBand=1.0,
+            highlightColor=QColor(Qt.blue),
+            backgroundColor=QColor(Qt.black),
+            **kwds):
+        super(QHeatmap, self).__init__(**kwds)
+
+        self.setMinimumSize(100,100)
+
+        self._colorBins = colorBins
+        self._highlightBand = highlightBand
+        self._backgroundColor = backgroundColor
+
+        # colour lookup table: height bins, then highlight, then unknown
+        lut = []
+        color = QColor()
+        for i in range(colorBins):
+            color.setHsvF(hueMin + (hueMax - hueMin) * i / float(colorBins), 1.0, 1.0)
+            lut.append(color.rgba())
+        lut.append(highlightColor.rgba())
+        lut.append(backgroundColor.rgba())
+        self._lut = np.array(lut, dtype=np.uint32)
+
+        # current image, and the buffer it was created from (QImage does not
+        # copy it)
+        self._image = None
+        self._image_buffer = None
+        self._frame_sequence = None
+
+
+    # O V E R R I D E   M E T H O D S
+    #===========================================================================
+    def paintEvent(self, e):
+        qp = QPainter(self)
+        qp.fillRect(self.rect(), self._backgroundColor)
+
+        if self._image is None:
+            return
+
+        # largest square-celled area centered in the widget
+        cell_size = min(self.width() / float(self._image.width()), self.height() / float(self._image.height()))
+        w = cell_size * self._image.width()
+        h = cell_size * self._image.height()
+        target = QRectF((self.width() - w) * 0.5, (self.height() - h) * 0.5, w, h)
+
+        qp.drawImage(target, self._image)
+
+
+    # P U B L I C   M E T H O D S
+    #===========================================================================
+    def setFrame(self, frame):
+        # displays a radar frame; frames that are already displayed are ignored
+        if frame is None or frame.sequence == self._frame_sequence:
+            return
+        self._frame_sequence = frame.sequence
+        self.setHeights(frame.heights, frame.reference_height)
+
+
+    def setHeights(self, heights, referenceHeight=None):
+        heights = np.asarray(heights, dtype=np.float64)
+        known = ~np.isnan(heights)
+
+        if known.any():
+            height_min = heights[known].min()
+            height_max = heights[known].max()
+        else:
+            height_min = height_max = 0.0
+        height_range = max(height_max - height_min, 1.0e-6)
+
+        # height bin of every cell, then the highlight and unknown cells
+        bins = (np.nan_to_num(heights - height_min) * ((self._colorBins - 0.1) / height_range)).astype(np.intp)
+        np.clip(bins, 0, self._colorBins - 1, out=bins)
+        if referenceHeight is not None:
+            bins[np.abs(heights - referenceHeight) < self._highlightBand] = self._colorBins
+        bins[~known] = self._colorBins + 1
+
+        self._image_buffer = np.ascontiguousarray(self._lut[bins[::-1]])
+        (rows, columns) = self._image_buffer.shape
+        self._image = QImage(self._image_buffer.data, columns, rows, columns * 4, QImage.Format_ARGB32)
+
+        self.update()
+
+
+    def clear(self):
+        self._image = None
+        self._image_buffer = None
+        self._frame_sequence = None
+        self.update()
+
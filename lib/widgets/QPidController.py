@@ -46,11 +46,12 @@ class QPidController(QtCore.QObject):
         
     # C O N S T R U C T O R 
     #===========================================================================
-    def __init__(self, kp, ki, kd, output_min, output_max, set_point, name="controller", **kwds):
+    def __init__(self, kp, ki, kd, output_min, output_max, set_point, name="controller", clock=None, rate='sts', **kwds):
         super(QPidController, self).__init__(**kwds)
         
-        self._pid = PidController(kp, ki, kd, output_min, output_max, set_point)
+        self._pid = PidController(kp, ki, kd, output_min, output_max, set_point, clock=clock)
         self.name = name
+        self.rate = rate    # scheduler tier the controller is updated on
         
         
     # M E T H O D S 
@@ -97,6 +98,9 @@ class QPidController(QtCore.QObject):
     def getOutputMax(self):
         return self._pid.output_max
         
+    def setClock(self, clock):
+        self._pid.set_clock(clock)
+        
     def setGainsEditable(self, is_editable):
         self._isGainsEditable = is_editable
         self.isGainsEditableChanged.emit(is_editable)
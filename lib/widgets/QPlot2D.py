@@ -403,6 +403,7 @@ class QPlot2DTime(QPlot2D):
             yTickInterval=0.2,
             labelFont=QFont("Segoe UI", 10),
             refreshRate=0.1,
+            clock=None,
             **kwds):
             
         # validate inputs
@@ -410,7 +411,8 @@ class QPlot2DTime(QPlot2D):
         
         self._timeSpan = timeSpan
         
-        self._lastUpdate = time.time()
+        self._clock = clock if clock is not None else MonotonicClock()
+        self._lastUpdate = self._clock.time()
         
         self._refreshRate = refreshRate
         
@@ -439,12 +441,17 @@ class QPlot2DTime(QPlot2D):
         value_tuple = (0.0, value)
         
         super(QPlot2DTime, self).updatePlot(plot_num, value_tuple)
+        
+        
+    def setClock(self, clock):
+        self._clock = clock
+        self._lastUpdate = self._clock.time()
 
 
     # P R I V A T E   M E T H O D S 
     #===========================================================================
     def _refresh_plots(self):
-        current_time = time.time()
+        current_time = self._clock.time()
         delta_time = current_time - self._lastUpdate
         
         for plot_key in self._plots.keys():